@@ -0,0 +1,77 @@
+"""
+Сравнение векторной установки покупателей DistributionSales._set_customers_ с построчным df.apply(_get_customer_).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_customers --rows 1000000
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.run import install_fake_connectors
+
+
+def import_distribution_sales():
+    """
+    DistributionSales без живых 1С и SQL02: та же подготовка, что и в benchmarks.run.run_case
+    """
+    os.makedirs('logs', exist_ok=True)  # distribution пишет лог в ./logs
+    install_fake_connectors()
+    from distribution import DistributionSales
+    return DistributionSales
+
+
+def make_customers_frame(rows, seed=0):
+    """
+    Синтетические продажи с колонками, которые нужны для установки покупателей
+    """
+    rng = np.random.default_rng(seed)
+    branches = np.array(['ДМ АШАН'] + [f'Shop {i}' for i in range(99)], dtype=object)
+    clients = np.array([f'Client {i}' for i in range(1000)], dtype=object)
+    client_codes = np.array(['00000003'] + [f'{i:08d}' for i in range(10, 1009)], dtype=object)
+    client_idx = rng.integers(0, 1000, rows)
+    # Примерно половина продаж идет на частное лицо
+    client_idx[rng.random(rows) < 0.5] = 0
+    return pd.DataFrame({
+        'branch': branches[rng.integers(0, 100, rows)],
+        'client_code': client_codes[client_idx],
+        'client': clients[client_idx],
+    })
+
+
+def set_customers_apply(df):
+    """
+    Установка покупателей построчно, как было до векторной версии
+    """
+    DistributionSales = import_distribution_sales()
+    df['client'] = df.apply(lambda x: DistributionSales._get_customer_(x), axis=1)
+    df.drop('client_code', axis=1, inplace=True)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vectorized vs row-wise customers resolution')
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    df = make_customers_frame(args.rows)
+    sales = import_distribution_sales()()
+
+    started = time.perf_counter()
+    vectorized = sales._set_customers_(df.copy())
+    vectorized_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    applied = set_customers_apply(df.copy())
+    apply_seconds = time.perf_counter() - started
+
+    assert vectorized['client'].tolist() == applied['client'].tolist(), 'Results differ'
+    print({'rows': args.rows, 'vectorized_seconds': round(vectorized_seconds, 3),
+           'apply_seconds': round(apply_seconds, 3), 'speedup': round(apply_seconds / vectorized_seconds, 1)})
+
+
+if __name__ == '__main__':
+    main()
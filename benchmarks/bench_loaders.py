@@ -0,0 +1,82 @@
+"""
+Замер скорости загрузчиков из loaders на SQLite.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_loaders --rows 200000 --batch-size 10000
+"""
+import argparse
+import datetime
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from loaders import LOADERS, get_loader
+
+SALES_TABLE_DDL = """
+    create table DistributionSales (
+        id integer primary key autoincrement,
+        code text, branch text, date_ date, name text, quantity_sold real, turnover real, turnover_wo_vat real,
+        cogs real, margin real, margin_percent real, client text, log_date timestamp
+    )
+"""
+
+
+def make_sales_frame(rows, seed=0):
+    """
+    Синтетические продажи в формате DistributionSales._get_sales_
+    """
+    rng = np.random.default_rng(seed)
+    turnover = rng.uniform(1, 1000, rows).round(2)
+    df = pd.DataFrame({
+        'code': rng.integers(0, 5000, rows).astype(str),
+        'branch': 'Shop ' + pd.Series(rng.integers(0, 100, rows)).astype(str),
+        'date_': pd.Series(datetime.date(2024, 1, 1) + datetime.timedelta(days=int(d))
+                           for d in rng.integers(0, 365, rows)),
+        'name': 'Item ' + pd.Series(rng.integers(0, 5000, rows)).astype(str),
+        'quantity_sold': rng.integers(1, 20, rows).astype(float),
+        'turnover': turnover,
+        'turnover_wo_vat': (turnover / 1.12).round(2),
+        'cogs': (turnover * 0.7).round(2),
+        'margin': (turnover * 0.19).round(2),
+        'margin_percent': 21.43,
+        'client': 'Client ' + pd.Series(rng.integers(0, 1000, rows)).astype(str),
+    }).set_index('code')
+    df['log_date'] = datetime.datetime.now()
+    return df
+
+
+def run(rows, batch_size, commit_every):
+    df = make_sales_frame(rows)
+    results = []
+    for name in LOADERS:
+        db_session = sqlite3.connect(':memory:')
+        db_session.execute(SALES_TABLE_DDL)
+        loader = get_loader(name, dialect='sqlite', batch_size=batch_size, commit_every=commit_every)
+
+        started = time.perf_counter()
+        loaded = loader.load(db_session, 'Analitycs.dbo.DistributionSales', df)
+        seconds = time.perf_counter() - started
+
+        assert db_session.execute('select count(*) from DistributionSales').fetchone()[0] == rows
+        db_session.close()
+        results.append({'loader': name, 'rows': loaded, 'seconds': round(seconds, 3),
+                        'rows_per_sec': round(loaded / seconds)})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk loaders throughput on SQLite')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--commit-every', type=int, default=None)
+    args = parser.parse_args()
+
+    for result in run(args.rows, args.batch_size, args.commit_every):
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
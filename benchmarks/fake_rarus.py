@@ -0,0 +1,243 @@
+"""
+Имитация подключения к 1С для замеров без живой базы.
+
+FakeRarusConnection по тексту запроса определяет, какой запрос выполняется (товары, продажи full/lean, контрольные суммы,
+справочник) и возвращает синтетическую выборку с теми же полями, что и 1С. Продажи генерируются по дням с фиксированным seed,
+поэтому одни и те же дни дают одинаковые данные при любой разбивке на окна.
+"""
+import datetime
+import re
+
+import numpy as np
+
+# Код частного лица (см. DistributionSales._get_customer_)
+PRIVATE_PERSON_CODE = '00000003'
+
+
+class FakeConfig:
+    """
+    Размер и кардинальность синтетических данных
+    """
+
+    def __init__(self, rows=10000, days=30, shops=50, skus=2000, customers=500, start_date=datetime.date(2024, 1, 1),
+                 suppliers=None, seed=0):
+        """
+        :param rows: Количество строк продаж за все дни
+        :param days: Количество дней продаж начиная с start_date
+        :param shops: Количество подразделений. Первое подразделение - ДМ АШАН
+        :param skus: Количество товаров
+        :param customers: Количество покупателей. Первый покупатель - частное лицо
+        :param suppliers: Кода поставщиков. По умолчанию DistributionGoods.DISTRIBUTION_SUPPLIERS_BRANDS
+        """
+        self.rows = rows
+        self.days = days
+        self.shops = shops
+        self.skus = skus
+        self.customers = customers
+        self.start_date = start_date
+        self.suppliers = suppliers
+        self.seed = seed
+
+    @property
+    def end_date(self):
+        return self.start_date + datetime.timedelta(days=self.days - 1)
+
+    def shop_code(self, i):
+        return f'B{i:04d}'
+
+    def shop_name(self, i):
+        return 'ДМ АШАН' if i == 0 else f'Shop {i}'
+
+    def sku_code(self, i):
+        return f'S{i:07d}'
+
+    def customer_code(self, i):
+        return PRIVATE_PERSON_CODE if i == 0 else f'K{i:07d}'
+
+    def customer_name(self, i):
+        return 'Частное лицо' if i == 0 else f'Customer {i}'
+
+
+class FakeSelection:
+    """
+    Выборка 1С: next() переходит к следующей строке, поля строки доступны как атрибуты.
+    Данные приходят пачками {поле: список значений}, в памяти одна пачка.
+    """
+
+    def __init__(self, batches):
+        self._batches = iter(batches)
+        self._columns = {}
+        self._size = 0
+        self._i = -1
+
+    def next(self):
+        self._i += 1
+        while self._i >= self._size:
+            batch = next(self._batches, None)
+            if batch is None:
+                return False
+            self._columns = batch
+            self._size = len(next(iter(batch.values()), []))
+            self._i = 0
+        return True
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_columns'][name][self._i]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeQuery:
+
+    def __init__(self, config, text):
+        self.config = config
+        self.text = text
+
+    def Execute(self):
+        return self
+
+    def Choose(self):
+        if 'Справочник.' in self.text:
+            return FakeSelection([self._names_()])
+        if 'СогласованиеЦен' in self.text:
+            return FakeSelection([self._goods_()])
+        if 'Продажи' in self.text and 'КАК Code' not in self.text:
+            return FakeSelection(self._control_totals_())
+        if 'Продажи' in self.text:
+            return FakeSelection(self._sales_())
+        if self.text.strip() == 'ВЫБРАТЬ 1':
+            return FakeSelection([])
+        raise ValueError(f'Unknown query: {self.text[:200]}')
+
+    def _dates_(self):
+        dates = re.findall(r'ДАТАВРЕМЯ\((\d+), (\d+), (\d+)', self.text)
+        return [datetime.date(*map(int, date)) for date in dates]
+
+    def _names_(self):
+        codes = re.findall(r'"([^"]+)"', self.text)
+        config = self.config
+        if 'Контрагенты' in self.text:
+            names = {config.customer_code(i): config.customer_name(i) for i in range(config.customers)}
+        else:
+            names = {config.shop_code(i): config.shop_name(i) for i in range(config.shops)}
+        codes = [code for code in codes if code in names]
+        return {'Code': codes, 'Name': [names[code] for code in codes]}
+
+    def _goods_(self):
+        """
+        Согласования цен: у товара i период start_date + (i % days) дней. Учитываются исключенные кода полного
+        запроса и водяные знаки поставщиков инкрементального запроса (Контрагент.Код = "..." И Период >= ДАТАВРЕМЯ)
+        """
+        config = self.config
+        excluded = set()
+        match = re.search(r'НЕ\s+\S+\.Номенклатура\.Код В \(([^)]*)\)', self.text)
+        if match:
+            excluded = set(re.findall(r'"?([^",\s]+)"?', match.group(1)))
+        watermarks = {supplier: datetime.datetime(*map(int, parts)) for supplier, *parts in re.findall(
+            r'Контрагент\.Код = "([^"]+)" И \S+\.Период >= ДАТАВРЕМЯ\((\d+), (\d+), (\d+), (\d+), (\d+), (\d+)\)',
+            self.text)}
+        suppliers = config.suppliers or sorted(set(re.findall(r'"(DR\d+|M\d+)"', self.text)))
+
+        codes, supplier_codes, periods = [], [], []
+        for i in range(config.skus):
+            code = config.sku_code(i)
+            supplier = suppliers[i % len(suppliers)]
+            period = datetime.datetime.combine(config.start_date + datetime.timedelta(days=i % config.days),
+                                               datetime.time())
+            if code in excluded or (supplier in watermarks and period < watermarks[supplier]):
+                continue
+            codes.append(code)
+            supplier_codes.append(supplier)
+            periods.append(period)
+        return {'Code': codes, 'Name': [f'Item {code}' for code in codes], 'SupplierCode': supplier_codes,
+                'Supplier': [f'Supplier {code}' for code in supplier_codes], 'Period': periods}
+
+    def _sales_(self):
+        """
+        Продажи по дням окна запроса. Пачка - один день
+        """
+        config = self.config
+        start_date, end_date = self._dates_()[:2]
+        rows_per_day = max(config.rows // config.days, 1)
+        day = max(start_date, config.start_date)
+        while day <= min(end_date, config.end_date):
+            yield self._sales_day_(day, rows_per_day)
+            day += datetime.timedelta(days=1)
+
+    def _control_totals_(self):
+        """
+        Контрольные суммы продаж по дню и подразделению (DistributionSales._build_control_totals_query_)
+        """
+        for batch in self._sales_():
+            totals = {}
+            for shop, date_, qty, turnover, cogs in zip(batch['Shop'], batch['Date_'], batch['Qty'],
+                                                        batch['Turnover'], batch['COGS']):
+                total = totals.setdefault((date_, shop), [0.0, 0.0, 0.0])
+                total[0] += qty
+                total[1] += turnover
+                total[2] += cogs
+            keys = list(totals)
+            yield {'Date_': [date_ for date_, _ in keys], 'Shop': [shop for _, shop in keys],
+                   'Qty': [totals[key][0] for key in keys], 'Turnover': [totals[key][1] for key in keys],
+                   'COGS': [totals[key][2] for key in keys]}
+
+    def _sales_day_(self, day, rows):
+        config = self.config
+        rng = np.random.default_rng(config.seed + day.toordinal())
+        shops = rng.integers(0, config.shops, rows)
+        skus = rng.integers(0, config.skus, rows)
+        customers = rng.integers(0, config.customers, rows)
+        customers[rng.random(rows) < 0.5] = 0
+        qty = rng.integers(1, 20, rows).astype(float)
+        turnover = (qty * rng.uniform(1, 100, rows)).round(2)
+        vat = (turnover * 0.12 / 1.12).round(2)
+        cost = (turnover * rng.uniform(0.5, 0.9, rows)).round(2)
+        vat_in = (cost * 0.12 / 1.12).round(2)
+        turnover_wo_vat = turnover - vat
+        cogs = cost - vat_in
+        margin = turnover_wo_vat - cogs
+
+        shop_names = [config.shop_name(i) for i in range(config.shops)]
+        customer_codes = [config.customer_code(i) for i in range(config.customers)]
+        customer_names = [config.customer_name(i) for i in range(config.customers)]
+        sku_codes = [config.sku_code(i) for i in skus]
+        date_ = datetime.datetime.combine(day, datetime.time())
+        return {
+            'Shop': [shop_names[i] for i in shops],
+            'ShopCode': [config.shop_code(i) for i in shops],
+            'Date_': [date_] * rows,
+            'Code': sku_codes,
+            'Name': [f'Item {code}' for code in sku_codes],
+            'Qty': qty.tolist(),
+            'Turnover': turnover.tolist(),
+            'VAT': vat.tolist(),
+            'Cost': cost.tolist(),
+            'VATIn': vat_in.tolist(),
+            'Turnover_wo_vat': turnover_wo_vat.round(2).tolist(),
+            'COGS': cogs.round(2).tolist(),
+            'Margin': margin.round(2).tolist(),
+            'Margin_percent': (margin / turnover_wo_vat * 100).round(2).tolist(),
+            'CustomerCode': [customer_codes[i] for i in customers],
+            'Customer': [customer_names[i] for i in customers],
+        }
+
+
+class FakeRarusConnection:
+    """
+    Подмена COM подключения create_rarus_connection()
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def NewObject(self, kind, text):
+        assert kind == 'Query', f'Unsupported object {kind}'
+        return FakeQuery(self.config, text)
+
+
+def fake_rarus_factory(config):
+    """
+    Функция создания подключения для ConnectionManager(rarus_factory=...)
+    """
+    return lambda: FakeRarusConnection(config)
@@ -0,0 +1,204 @@
+"""
+Сквозной замер DistributionGoods и DistributionSales без живых 1С и SQL02.
+
+1С подменяется benchmarks.fake_rarus, SQL02 - файлом SQLite (benchmarks.sqlite_db). Каждый размер запускается
+в отдельном процессе, чтобы пиковая память не накапливалась между запусками.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --sizes 10000 100000 1000000 --window week --workers 2
+    python -m benchmarks.run --sizes 10000 100000 --save-baseline
+    python -m benchmarks.run --sizes 10000 100000            # сравнение с сохраненным baseline
+
+Если rows/sec упал или пиковая память выросла больше чем на --tolerance относительно baseline,
+то скрипт завершается с кодом 1. Замеры, для которых в baseline нет записи (например, после изменения
+CASE_OPTIONS ключи замеров меняются), выводятся как предупреждения. Если baseline есть, но ни один замер
+не нашел в нем запись, то это тоже ошибка: сравнивать не с чем, нужен --save-baseline.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from benchmarks.fake_rarus import FakeConfig, fake_rarus_factory
+from benchmarks.sqlite_db import sqlite_sql_factory
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+CASE_OPTIONS = ('window', 'workers', 'chunk_size', 'profile', 'pipelined', 'compact', 'swap', 'loader',
+                'batch_size')
+
+
+def install_fake_connectors():
+    """
+    Если пакета connectors нет (локальная машина без доступа к 1С и SQL02), то регистрируем модуль-заглушку,
+    чтобы distribution импортировался. Все подключения в замерах все равно идут через ConnectionManager с
+    подмененными функциями.
+    """
+    try:
+        importlib.import_module('connectors.connection')
+    except ImportError:
+        def not_available():
+            raise RuntimeError('Real connections are not available in benchmarks')
+
+        connectors = types.ModuleType('connectors')
+        connection = types.ModuleType('connectors.connection')
+        connection.create_rarus_connection = not_available
+        connection.create_sql02_connection = not_available
+        connectors.connection = connection
+        sys.modules['connectors'] = connectors
+        sys.modules['connectors.connection'] = connection
+
+
+def case_key(case):
+    options = ','.join(f'{option}={case[option]}' for option in CASE_OPTIONS)
+    return f"{case['rows']}:{options}"
+
+
+def run_case(case):
+    """
+    Один замер в текущем процессе
+    :param case: Размер данных и параметры DistributionSales
+    :return result -> dict:
+    """
+    os.makedirs('logs', exist_ok=True)  # distribution пишет лог в ./logs
+    install_fake_connectors()
+    from connection_manager import ConnectionManager
+    from distribution import DistributionGoods, DistributionSales
+    from loaders import get_loader
+    from metrics import RunMetrics, peak_rss_mb
+
+    config = FakeConfig(rows=case['rows'], days=case['days'], shops=case['shops'], skus=case['skus'],
+                        customers=case['customers'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.sqlite')
+        manager = ConnectionManager(sql_factory=sqlite_sql_factory(db_path), rarus_factory=fake_rarus_factory(config))
+        DistributionGoods.connections = manager
+        DistributionSales.connections = manager
+        loader = get_loader(case['loader'], dialect='sqlite', batch_size=case['batch_size'])
+
+        started = time.perf_counter()
+        DistributionGoods(loader=loader, metrics=RunMetrics('goods', output_dir=None))()
+        goods_seconds = time.perf_counter() - started
+
+        sales = DistributionSales(append=False, start_date=config.start_date, end_date=config.end_date,
+                                  window=case['window'], workers=case['workers'], chunk_size=case['chunk_size'],
+                                  loader=loader, pipelined=case['pipelined'], compact=case['compact'],
+                                  profile=case['profile'], swap=case['swap'],
+                                  metrics=RunMetrics('sales', output_dir=None))
+        started = time.perf_counter()
+        sales()
+        sales_seconds = time.perf_counter() - started
+
+        with manager.sql() as db_session:
+            rows = db_session.execute(f'select count(*) from {sales.DB_TABLE_NAME}').fetchone()[0]
+        manager.close()
+
+    return {
+        'key': case_key(case),
+        'rows': rows,
+        'goods_seconds': round(goods_seconds, 3),
+        'sales_seconds': round(sales_seconds, 3),
+        'rows_per_sec': round(rows / sales_seconds) if sales_seconds else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'windows': sales.windows_stats,
+        'pipeline': sales.pipeline_stats,
+        'extract': sales.extract_stats,
+        'stages': sales.metrics.as_dict()['stages'],
+        'connections': manager.stats(),
+    }
+
+
+def run_case_in_subprocess(case):
+    process = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--case', json.dumps(case)],
+                             capture_output=True, text=True)
+    if process.returncode:
+        raise RuntimeError(f'Benchmark case {case_key(case)} failed:\n{process.stderr}')
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    :return (regressions, missing) -> ([str], [str]): Описание регрессий и ключи замеров без записи в baseline
+    """
+    regressions = []
+    missing = []
+    for result in results:
+        base = baseline.get(result['key'])
+        if not base:
+            missing.append(result['key'])
+            continue
+        if base['rows_per_sec'] and result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            regressions.append(f"{result['key']}: rows/sec {result['rows_per_sec']} < {base['rows_per_sec']}")
+        if base['peak_rss_mb'] and result['peak_rss_mb'] and \
+                result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{result['key']}: peak RSS {result['peak_rss_mb']}MB > {base['peak_rss_mb']}MB")
+    return regressions, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline DistributionGoods/DistributionSales benchmark')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--shops', type=int, default=50)
+    parser.add_argument('--skus', type=int, default=2000)
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--window', choices=['day', 'week', 'month'], default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--profile', choices=['full', 'lean'], default='full')
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--swap', action='store_true', help='Requires --loader staging')
+    parser.add_argument('--loader', default='executemany')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case)), default=str))
+        return
+
+    results = []
+    for size in args.sizes:
+        case = {'rows': size, 'days': args.days, 'shops': args.shops, 'skus': args.skus,
+                'customers': args.customers, **{option: getattr(args, option) for option in CASE_OPTIONS}}
+        result = run_case_in_subprocess(case)
+        results.append(result)
+        print(json.dumps({key: result[key] for key in ('key', 'rows', 'sales_seconds', 'rows_per_sec',
+                                                       'peak_rss_mb')}))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if args.save_baseline:
+        baseline.update({result['key']: {'rows_per_sec': result['rows_per_sec'], 'peak_rss_mb': result['peak_rss_mb'],
+                                         'date': datetime.date.today().isoformat()} for result in results})
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    regressions, missing = compare_with_baseline(results, baseline, args.tolerance)
+    for key in missing:
+        print(f'WARNING no baseline for {key}')
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if baseline and len(missing) == len(results):
+        print(f'ERROR none of the cases matched {args.baseline}. Case keys may have changed, run with --save-baseline')
+        sys.exit(1)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
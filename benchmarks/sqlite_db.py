@@ -0,0 +1,105 @@
+"""
+SQLite вместо SQL02 для замеров без живой БД.
+
+SqliteSession повторяет то, что код использует у подключения pyodbc: execute(...).fetchone()/fetchall(),
+cursor(), commit(), rollback(), close(). Трехчастные имена таблиц вида Analitycs.dbo.DistributionSales
+в тексте запросов заменяются на имя таблицы.
+"""
+import datetime
+import re
+import sqlite3
+
+# Схема таблиц, с которыми работают DistributionGoods и DistributionSales
+SCHEMA = """
+    create table if not exists DistributionGoods (
+        code text primary key, name text, supplier_name text, brand text, log_date timestamp
+    );
+    create table if not exists DistributionSales (
+        id integer primary key autoincrement,
+        code text, branch text, date_ date, name text, quantity_sold real, turnover real, turnover_wo_vat real,
+        cogs real, margin real, margin_percent real, client text, log_date timestamp
+    );
+    create index if not exists ix_DistributionSales_date on DistributionSales (date_);
+    create table if not exists DistributionSalesCompact (
+        id integer primary key autoincrement,
+        shop_id integer, date_ date, sku_id integer, client_id integer, quantity_sold real, turnover real,
+        turnover_wo_vat real, cogs real, margin real, margin_percent real, log_date timestamp
+    );
+    create table if not exists DistributionDimShop (shop_id integer primary key, branch text);
+    create table if not exists DistributionDimSku (sku_id integer primary key, code text, name text);
+    create table if not exists DistributionDimClient (client_id integer primary key, client text);
+    create unique index if not exists ux_DistributionDimShop_branch on DistributionDimShop (branch);
+    create unique index if not exists ux_DistributionDimSku_code on DistributionDimSku (code);
+    create unique index if not exists ux_DistributionDimClient_client on DistributionDimClient (client);
+"""
+# Таблицы агрегатов rollups.RollupStore.ROLLUPS
+for _table, _key_column in (('DistributionSalesWeekBranch', 'branch'), ('DistributionSalesMonthBranch', 'branch'),
+                            ('DistributionSalesWeekClient', 'client'), ('DistributionSalesMonthClient', 'client')):
+    SCHEMA += f"""
+    create table if not exists {_table} (
+        period_start date, brand text, {_key_column} text, quantity_sold real, turnover real, turnover_wo_vat real,
+        cogs real, margin real
+    );
+    create unique index if not exists ix_{_table}_period on {_table} (period_start, brand, {_key_column});
+"""
+
+_THREE_PART_NAME = re.compile(r'\b\w+\.dbo\.(\w+)', re.IGNORECASE)
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def _convert_value_(value):
+    # Агрегаты (max(date_)) в sqlite теряют тип колонки, поэтому даты возвращаются строкой
+    if isinstance(value, str) and _DATE.match(value):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+class SqliteResult:
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return None if row is None else tuple(_convert_value_(value) for value in row)
+
+    def fetchall(self):
+        return [tuple(_convert_value_(value) for value in row) for row in self.cursor.fetchall()]
+
+
+class SqliteSession:
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                                          timeout=60)
+
+    def execute(self, sql, *params):
+        # Параметры как в pyodbc: execute(sql, p1, p2, ...)
+        return SqliteResult(self.connection.execute(_THREE_PART_NAME.sub(r'\1', sql), params))
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+def create_schema(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.commit()
+    connection.close()
+
+
+def sqlite_sql_factory(path):
+    """
+    Функция создания подключения для ConnectionManager(sql_factory=...)
+    """
+    create_schema(path)
+    return lambda: SqliteSession(path)
@@ -0,0 +1,281 @@
+import argparse
+import datetime
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow  # движок Parquet файлов кэша
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = pq = None
+
+# Каталог кэша по умолчанию
+CACHE_DIR = './cache'
+# Ключ метаданных Parquet с отпечатком параметров выгрузки
+FINGERPRINT_KEY = b'distribution_fingerprint'
+
+
+class ExtractCache:
+    """
+    Локальный кэш выгрузок из 1С в Parquet файлах. Один файл на вид выгрузки и день:
+        {root}/{kind}/{YYYY-MM-DD}.parquet
+
+    Для дней без данных пишется пустой файл, чтобы такие дни тоже не запрашивались повторно.
+    Файлы старше ttl_days считаются устаревшими. Если общий размер кэша больше max_bytes, то удаляются файлы,
+    которые дольше всех не читались (LRU по времени доступа).
+    Файл может быть удален вытеснением из другого потока в любой момент, поэтому read_day для исчезнувшего файла
+    возвращает None (промах кэша).
+
+    Результат выгрузки может зависеть не только от дня, но и от параметров запроса (например, списка товаров
+    в фильтре продаж). Такие параметры передаются как fingerprint: отпечаток пишется в метаданные файла, и файл
+    с другим отпечатком считается промахом кэша.
+    """
+
+    def __init__(self, root=CACHE_DIR, ttl_days=None, max_bytes=None):
+        """
+        :param root: Каталог кэша
+        :param ttl_days: Время жизни файла в днях с момента записи. None - без ограничения
+        :param max_bytes: Максимальный размер кэша в байтах. None - без ограничения
+        """
+        assert pyarrow is not None, 'pyarrow is required for the extract cache'
+        self.root = root
+        self.ttl_days = ttl_days
+        self.max_bytes = max_bytes
+        self._evict_lock = threading.Lock()
+
+    @staticmethod
+    def days(start_date, end_date):
+        return [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+    def _path_(self, kind, day):
+        return os.path.join(self.root, kind, f'{day.isoformat()}.parquet')
+
+    @staticmethod
+    def _matches_(path, metadata, fingerprint):
+        if fingerprint is None or (metadata or {}).get(FINGERPRINT_KEY) == fingerprint.encode():
+            return True
+        logging.info(f'Cache partition {path} was written with other parameters')
+        return False
+
+    def is_fresh(self, kind, day, fingerprint=None):
+        """
+        Есть ли в кэше не устаревший файл за день
+        :param fingerprint: Отпечаток параметров выгрузки. Если задан, то файл с другим отпечатком не подходит
+        """
+        path = self._path_(kind, day)
+        try:
+            mtime = os.path.getmtime(path)
+            metadata = pq.read_schema(path).metadata if fingerprint is not None else None
+        except FileNotFoundError:
+            return False
+        if self.ttl_days is not None and time.time() - mtime > self.ttl_days * 86400:
+            logging.info(f'Cache partition {path} is expired')
+            return False
+        return self._matches_(path, metadata, fingerprint)
+
+    def missing_days(self, kind, start_date, end_date, fingerprint=None):
+        """
+        Дни периода, которых нет в кэше, они устарели или записаны с другим отпечатком
+        """
+        return [day for day in self.days(start_date, end_date) if not self.is_fresh(kind, day, fingerprint)]
+
+    def read_day(self, kind, day, fingerprint=None):
+        """
+        Чтение файла за день. Время доступа файла обновляется для LRU, время записи (для TTL) не меняется.
+        :return df {DataFrame} или None, если файла нет (например, его удалило вытеснение) или у него другой
+            отпечаток
+        """
+        path = self._path_(kind, day)
+        try:
+            table = pq.read_table(path)
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except FileNotFoundError:
+            logging.info(f'Cache partition {path} is missing')
+            return None
+        if not self._matches_(path, table.schema.metadata, fingerprint):
+            return None
+        return table.to_pandas()
+
+    def read(self, kind, start_date, end_date, fingerprint=None):
+        """
+        Чтение периода из кэша
+        :return df {DataFrame} или None, если каких-то дней нет в кэше
+        """
+        if self.missing_days(kind, start_date, end_date, fingerprint):
+            return None
+
+        logging.info(f'Reading {kind} for the period {start_date} - {end_date} from cache')
+        frames = [self.read_day(kind, day, fingerprint) for day in self.days(start_date, end_date)]
+        if any(df is None for df in frames):
+            return None
+        return pd.concat(frames)
+
+    def write_day(self, kind, day, df, fingerprint=None):
+        path = self._path_(kind, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pyarrow.Table.from_pandas(df)
+        if fingerprint is not None:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   FINGERPRINT_KEY: fingerprint.encode()})
+        tmp_path = f'{path}.tmp'
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def write(self, kind, df, start_date, end_date, date_column='date_', fingerprint=None):
+        """
+        Запись периода в кэш по дням. Для дней периода без данных пишутся пустые файлы.
+        :param df: Данные за период
+        :param date_column: Колонка с датой, по которой данные делятся на дни
+        :param fingerprint: Отпечаток параметров выгрузки
+        """
+        logging.info(f'Writing {kind} for the period {start_date} - {end_date} to cache')
+        with self.writer(kind, start_date, end_date, date_column, fingerprint) as writer:
+            writer.add(df)
+
+    def writer(self, kind, start_date, end_date, date_column='date_', fingerprint=None):
+        return CachePartitionWriter(self, kind, start_date, end_date, date_column, fingerprint)
+
+    def invalidate(self, kind, start_date, end_date):
+        """
+        Удаление файлов периода из кэша
+        """
+        for day in self.days(start_date, end_date):
+            try:
+                os.remove(self._path_(kind, day))
+            except FileNotFoundError:
+                pass
+        logging.info(f'Invalidated {kind} cache for the period {start_date} - {end_date}')
+
+    def evict(self):
+        """
+        Удаление файлов, которые дольше всех не читались, пока размер кэша больше max_bytes.
+        Если вытеснение уже идет в другом потоке, то повторно оно не запускается.
+        :return removed -> int: Количество удаленных файлов
+        """
+        if self.max_bytes is None:
+            return 0
+        if not self._evict_lock.acquire(blocking=False):
+            return 0
+
+        try:
+            files = []
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    if name.endswith('.parquet'):
+                        path = os.path.join(directory, name)
+                        try:
+                            stat = os.stat(path)
+                        except FileNotFoundError:
+                            continue
+                        files.append((stat.st_atime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            self._evict_lock.release()
+
+        if removed:
+            logging.info(f'Evicted {removed} cache partitions. Cache size: {total} bytes')
+        return removed
+
+
+class CachePartitionWriter:
+    """
+    Запись в кэш данных, которые приходят частями, упорядоченными по дате (как результат запроса продаж).
+    Все дни части, кроме последнего, считаются полными и сразу пишутся в кэш. Последний день ждет следующую часть,
+    поэтому в памяти хранится не больше одного дня.
+    """
+
+    def __init__(self, cache, kind, start_date, end_date, date_column='date_', fingerprint=None):
+        self.cache = cache
+        self.kind = kind
+        self.start_date = start_date
+        self.end_date = end_date
+        self.date_column = date_column
+        self.fingerprint = fingerprint
+        self.pending = []
+        self.empty = None
+        self.written = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # При ошибке последний день может быть неполным, поэтому он не пишется
+        if exc_type is None:
+            self.close()
+
+    def _flush_(self, day, frames):
+        self.cache.write_day(self.kind, day, pd.concat(frames), self.fingerprint)
+        self.written.add(day)
+
+    def add(self, df):
+        if self.empty is None:
+            self.empty = df.iloc[0:0]
+        if df.empty:
+            return
+
+        frames = self.pending + [df]
+        data = pd.concat(frames) if len(frames) > 1 else df
+        days = sorted(set(data[self.date_column]))
+        for day, day_df in data.groupby(self.date_column, sort=True):
+            if day != days[-1]:
+                self._flush_(day, [day_df])
+            else:
+                self.pending = [day_df]
+
+    def close(self):
+        if self.pending:
+            self._flush_(self.pending[0][self.date_column].iloc[0], self.pending)
+            self.pending = []
+        if self.empty is not None:
+            for day in self.cache.days(self.start_date, self.end_date):
+                if day not in self.written:
+                    self.cache.write_day(self.kind, day, self.empty, self.fingerprint)
+        self.cache.evict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distribution extract cache')
+    parser.add_argument('command', choices=['reload-sales', 'reload-goods', 'invalidate', 'evict'])
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='Start date YYYY-MM-DD')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='End date YYYY-MM-DD')
+    parser.add_argument('--kind', default='sales', help='Cache kind for invalidate')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--ttl-days', type=float, default=None)
+    parser.add_argument('--max-bytes', type=int, default=None)
+    args = parser.parse_args()
+
+    cache = ExtractCache(args.cache_dir, ttl_days=args.ttl_days, max_bytes=args.max_bytes)
+    if args.command == 'evict':
+        cache.evict()
+        return
+
+    assert args.start and args.end, '--start and --end are required'
+    if args.command == 'invalidate':
+        cache.invalidate(args.kind, args.start, args.end)
+        return
+
+    # Импорт здесь, чтобы команды кэша не требовали подключений к 1С и БД
+    from distribution import DistributionGoods, DistributionSales
+    if args.command == 'reload-sales':
+        DistributionSales(append=False, cache=cache).reload_from_cache(args.start, args.end)
+    else:
+        DistributionGoods(cache=cache).reload_from_cache(args.start, args.end)
+
+
+if __name__ == '__main__':
+    main()
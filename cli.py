@@ -0,0 +1,146 @@
+"""
+Запуск выгрузки товаров и продаж без диалога с пользователем.
+
+Примеры:
+    python cli.py                                              # товары и дозагрузка продаж (append)
+    python cli.py sales --start 2024-01-01 --end 2024-06-30 --window week --workers 4
+    python cli.py sales --start 2024-01-01 --end 2024-06-30 --window week --restart
+    python cli.py reconcile --start 2024-06-01 --end 2024-06-30
+    python cli.py sales --rollups                              # дозагрузка продаж и пересчет агрегатов
+    python cli.py rollups-rebuild
+    python cli.py rollups-check --start 2024-06-01 --end 2024-06-30
+
+Если заданы --start и --end, то продажи за период выгружаются по окнам (по умолчанию DEFAULT_WINDOW) и каждое окно
+заменяет свои продажи в БД (DistributionSales(swap=True)). Выполненные окна сохраняются в checkpoint, поэтому
+повторный запуск той же команды после сбоя продолжает с невыполненных окон. Без дат продажи дополняются
+с максимальной даты в БД.
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+from cache import CACHE_DIR, ExtractCache
+from connection_manager import default_manager
+from distribution import DistributionGoods, DistributionSales
+from loaders import ExecuteManyLoader, StagingTableLoader
+from metrics import METRICS_DIR, RunMetrics
+from state import STATE_DIR, WindowCheckpoint
+
+COMMANDS = ('both', 'goods', 'sales', 'reconcile', 'rollups-rebuild', 'rollups-check')
+# Окно выгрузки периода по умолчанию. Без окна весь период был бы одним окном: одна транзакция и одна запись
+# checkpoint, и после сбоя период выгружался бы заново целиком
+DEFAULT_WINDOW = 'week'
+
+
+def checkpoint_path(args):
+    """
+    Файл checkpoint по умолчанию. Свой для каждого периода и окна, чтобы разные периоды можно было
+    выгружать параллельно
+    """
+    return os.path.join(STATE_DIR, f'sales_checkpoint_{args.start}_{args.end}_{args.window}.json')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Distribution goods and sales loader')
+    parser.add_argument('command', nargs='?', choices=COMMANDS, default='both')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='Start date YYYY-MM-DD')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='End date YYYY-MM-DD')
+    parser.add_argument('--window', choices=DistributionSales.WINDOWS, default=None,
+                        help=f'Sales window with --start and --end. Default: {DEFAULT_WINDOW}')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--profile', choices=DistributionSales.PROFILES, default='full')
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--resync-days', type=int, default=0, help='Re-sync last N days in append mode')
+    parser.add_argument('--checkpoint', default=None, help='Checkpoint file. By default depends on period and window')
+    parser.add_argument('--restart', action='store_true', help='Ignore completed windows from the checkpoint')
+    parser.add_argument('--incremental-goods', action='store_true')
+    parser.add_argument('--rollups', action='store_true', help='Refresh rollups of the loaded periods')
+    parser.add_argument('--cache-dir', default=None, help=f'Extract cache directory, e.g. {CACHE_DIR}')
+    parser.add_argument('--cache-ttl-days', type=float, default=None, help='Re-extract cached days older than this')
+    parser.add_argument('--cache-max-bytes', type=int, default=None)
+    parser.add_argument('--metrics-dir', default=METRICS_DIR)
+    parser.add_argument('--prometheus', default=None, help='Path of Prometheus textfile with run metrics')
+    args = parser.parse_args(argv)
+
+    if bool(args.start) != bool(args.end):
+        parser.error('--start and --end must be used together')
+    if args.start and args.start > args.end:
+        parser.error('--start must be <= --end')
+    if args.command == 'reconcile' and not args.start:
+        parser.error('reconcile requires --start and --end')
+    if args.start and args.resync_days:
+        parser.error('--resync-days is used only without --start and --end')
+    if args.start and not args.window:
+        args.window = DEFAULT_WINDOW
+    return args
+
+
+def create_cache(args):
+    if not args.cache_dir:
+        return None
+    return ExtractCache(args.cache_dir, ttl_days=args.cache_ttl_days, max_bytes=args.cache_max_bytes)
+
+
+def run_goods(args):
+    metrics = RunMetrics('goods', output_dir=args.metrics_dir, prometheus_path=args.prometheus)
+    goods = DistributionGoods(chunk_size=args.chunk_size, loader=ExecuteManyLoader(batch_size=args.batch_size),
+                              incremental=args.incremental_goods, metrics=metrics, cache=create_cache(args))
+    goods()
+
+
+def create_sales(args, **kwargs):
+    metrics = RunMetrics('sales', output_dir=args.metrics_dir, prometheus_path=args.prometheus)
+    return DistributionSales(start_date=args.start, end_date=args.end, window=args.window, workers=args.workers,
+                             chunk_size=args.chunk_size, loader=StagingTableLoader(batch_size=args.batch_size),
+                             cache=create_cache(args), compact=args.compact, profile=args.profile, metrics=metrics,
+                             swap=True, interactive=False, rollups=args.rollups, **kwargs)
+
+
+def run_sales(args):
+    if not args.start:
+        create_sales(args, append=True, resync_days=args.resync_days)()
+        return
+
+    checkpoint = WindowCheckpoint(args.checkpoint or checkpoint_path(args))
+    if args.restart:
+        checkpoint.reset()
+    create_sales(args, append=False, checkpoint=checkpoint)()
+
+
+def run_rollups(args):
+    args.rollups = True
+    sales = create_sales(args)
+    if args.command == 'rollups-rebuild':
+        sales.rebuild_rollups()
+        return True
+
+    mismatches = sales.check_rollups(args.start, args.end)
+    for mismatch in mismatches:
+        group = {key: value for key, value in mismatch.items() if key not in ('table', 'period_start', 'sales', 'rollup')}
+        print(f"MISMATCH {mismatch['table']} {mismatch['period_start']} {group}: sales {mismatch['sales']} "
+              f"rollup {mismatch['rollup']}")
+    return not mismatches
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.command in ('both', 'goods'):
+            run_goods(args)
+        if args.command in ('both', 'sales'):
+            run_sales(args)
+        if args.command == 'reconcile':
+            create_sales(args, append=False).reconcile()
+        if args.command.startswith('rollups-') and not run_rollups(args):
+            logging.error('Rollups do not match sales')
+            sys.exit(1)
+    finally:
+        default_manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from connectors.connection import create_rarus_connection, create_sql02_connection
+
+try:
+    import pythoncom  # COM нужно инициализировать в каждом потоке, который работает с 1С
+except ImportError:
+    pythoncom = None
+
+
+class ConnectionManager:
+    """
+    Повторное использование подключений к SQL Server и 1С.
+
+    SQL: закрытые через sql() сессии возвращаются в пул и отдаются следующему sql(). Если при работе с сессией
+    произошла ошибка, то сессия закрывается, а не возвращается в пул.
+    1С: у каждого потока одно долгоживущее COM подключение. Поток, который работает с 1С, оборачивается в
+    rarus_thread(): там инициализируется COM, а на выходе подключение потока освобождается.
+
+    Подключения, которые не использовались дольше health_check_interval секунд, перед выдачей проверяются
+    простым запросом. Если проверка не прошла, то создается новое подключение.
+    Время создания подключений копится в stats().
+    """
+
+    def __init__(self, sql_factory=create_sql02_connection, rarus_factory=create_rarus_connection, max_idle_sql=4,
+                 health_check_interval=60):
+        """
+        :param sql_factory: Функция создания подключения к SQL Server
+        :param rarus_factory: Функция создания подключения к 1С
+        :param max_idle_sql: Сколько свободных SQL сессий держать в пуле
+        :param health_check_interval: Через сколько секунд простоя подключение проверяется перед выдачей
+        """
+        self.sql_factory = sql_factory
+        self.rarus_factory = rarus_factory
+        self.max_idle_sql = max_idle_sql
+        self.health_check_interval = health_check_interval
+        self._idle_sql = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {'sql_connections': 0, 'sql_setup_seconds': 0.0,
+                       'rarus_connections': 0, 'rarus_setup_seconds': 0.0}
+
+    def _connect_(self, kind, factory):
+        started = time.perf_counter()
+        connection = factory()
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self._stats[f'{kind}_connections'] += 1
+            self._stats[f'{kind}_setup_seconds'] += seconds
+        logging.info(f'Created {kind} connection in {seconds:.3f}s')
+        return connection
+
+    def _is_alive_(self, kind, connection, last_used):
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            if kind == 'sql':
+                connection.execute('select 1').fetchone()
+            else:
+                connection.NewObject('Query', 'ВЫБРАТЬ 1').Execute()
+            return True
+        except Exception as err:
+            logging.warning(f'{kind} connection failed health check: {err}')
+            return False
+
+    def _acquire_sql_(self):
+        while True:
+            try:
+                session, last_used = self._idle_sql.get_nowait()
+            except queue.Empty:
+                return self._connect_('sql', self.sql_factory)
+            if self._is_alive_('sql', session, last_used):
+                return session
+            self._close_sql_(session)
+
+    @staticmethod
+    def _close_sql_(session):
+        try:
+            session.close()
+        except Exception as err:
+            logging.warning(f'Failed to close sql connection: {err}')
+
+    @contextmanager
+    def sql(self):
+        """
+        Сессия SQL Server из пула. При возврате в пул незакоммиченные изменения откатываются
+        """
+        session = self._acquire_sql_()
+        try:
+            yield session
+        except BaseException:
+            self._close_sql_(session)
+            raise
+        try:
+            # Незакоммиченная транзакция не должна перейти к следующему владельцу сессии
+            session.rollback()
+        except Exception as err:
+            logging.warning(f'Failed to rollback sql connection: {err}')
+            self._close_sql_(session)
+            return
+        if self._idle_sql.qsize() < self.max_idle_sql:
+            self._idle_sql.put((session, time.monotonic()))
+        else:
+            self._close_sql_(session)
+
+    @contextmanager
+    def rarus(self):
+        """
+        Подключение к 1С текущего потока
+        """
+        connection = getattr(self._local, 'rarus', None)
+        if connection is None or not self._is_alive_('rarus', connection, self._local.last_used):
+            connection = self._local.rarus = self._connect_('rarus', self.rarus_factory)
+        try:
+            yield connection
+        finally:
+            self._local.last_used = time.monotonic()
+
+    @contextmanager
+    def rarus_thread(self):
+        """
+        Обертка для потока, который работает с 1С: инициализация COM и освобождение подключения потока на выходе
+        """
+        if pythoncom is not None:
+            pythoncom.CoInitialize()
+        try:
+            yield
+        finally:
+            self._local.rarus = None
+            if pythoncom is not None:
+                pythoncom.CoUninitialize()
+
+    def stats(self):
+        """
+        Количество созданных подключений и время на их создание
+        """
+        with self._lock:
+            return {key: round(value, 3) for key, value in self._stats.items()}
+
+    def close(self):
+        """
+        Закрытие свободных SQL сессий и подключения к 1С текущего потока
+        """
+        while True:
+            try:
+                session, _ = self._idle_sql.get_nowait()
+            except queue.Empty:
+                break
+            self._close_sql_(session)
+        self._local.rarus = None
+
+
+# Общий менеджер подключений для DistributionGoods и DistributionSales
+default_manager = ConnectionManager()
@@ -0,0 +1,169 @@
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class Dimension:
+    """
+    Таблица измерения: целочисленный ключ id_column и натуральный ключ key_column (например, название подразделения).
+    attributes - дополнительные колонки, которые пишутся в таблицу при добавлении нового значения.
+    """
+
+    def __init__(self, table, id_column, key_column, attributes=()):
+        self.table = table
+        self.id_column = id_column
+        self.key_column = key_column
+        self.attributes = tuple(attributes)
+
+
+class DimensionStore:
+    """
+    Кодирование текстовых колонок продаж в целочисленные ключи измерений.
+    Известные значения хранятся в памяти и один раз читаются из таблиц измерений. Новые значения дописываются
+    в таблицы измерений перед записью продаж (loaders.BulkLoader.insert_missing), ключи им выдает БД (identity),
+    после чего ключи новых значений читаются из БД.
+
+    Измерения могут одновременно дописывать несколько процессов (например, выгрузки разных периодов): значение,
+    которое уже записал другой процесс, не дублируется, а получает его ключ. Ключи значений не меняются, поэтому
+    кэш в памяти не устаревает. Потоки одного процесса синхронизируются блокировкой.
+    """
+    DIMENSIONS = (
+        Dimension('Analitycs.dbo.DistributionDimShop', 'shop_id', 'branch'),
+        Dimension('Analitycs.dbo.DistributionDimSku', 'sku_id', 'code', attributes=('name', )),
+        Dimension('Analitycs.dbo.DistributionDimClient', 'client_id', 'client'),
+    )
+    # Сколько значений читать одним запросом ключей (SQL Server принимает не больше 2100 параметров)
+    FETCH_BATCH_SIZE = 1000
+
+    def __init__(self, loader):
+        """
+        :param loader: Загрузчик из loaders для записи новых значений измерений
+        """
+        self.loader = loader
+        self.keys = {}
+        self._lock = threading.Lock()
+
+    def _load_(self, db_session, dimension):
+        """
+        Чтение значений измерения из БД
+        :return keys -> dict: {натуральный ключ: id}
+        """
+        if dimension.table not in self.keys:
+            logging.info(f'Loading dimension {dimension.table}')
+            table = self.loader.table_name(dimension.table)
+            rows = db_session.execute(f'select {dimension.key_column}, {dimension.id_column} from {table}').fetchall()
+            self.keys[dimension.table] = {key: id_ for key, id_ in rows}
+
+        return self.keys[dimension.table]
+
+    def _fetch_ids_(self, db_session, dimension, values):
+        """
+        Ключи значений измерения из БД
+        :param values: Натуральные ключи
+        :return keys -> dict: {натуральный ключ: id}
+        """
+        table = self.loader.table_name(dimension.table)
+        keys = {}
+        for start in range(0, len(values), self.FETCH_BATCH_SIZE):
+            batch = values[start:start + self.FETCH_BATCH_SIZE]
+            rows = db_session.execute(f'select {dimension.key_column}, {dimension.id_column} from {table} '
+                                      f'where {dimension.key_column} in ({", ".join("?" * len(batch))})',
+                                      *batch).fetchall()
+            keys.update((key, id_) for key, id_ in rows)
+
+        return keys
+
+    def _add_members_(self, db_session, dimension, df):
+        """
+        Добавление новых значений измерения в БД и их ключей в память. Значения, которые уже записал другой
+        процесс, не пишутся повторно, их ключи тоже читаются из БД
+        """
+        keys = self._load_(db_session, dimension)
+        members = df[[dimension.key_column, *dimension.attributes]].drop_duplicates(dimension.key_column)
+        members = members[~members[dimension.key_column].isin(keys.keys())]
+        if members.empty:
+            return
+
+        logging.info(f'Adding {len(members)} members to dimension {dimension.table}')
+        self.loader.insert_missing(db_session, dimension.table, members, dimension.key_column)
+        values = members[dimension.key_column].tolist()
+        new_keys = self._fetch_ids_(db_session, dimension, values)
+        missing = [value for value in values if value not in new_keys]
+        assert not missing, f'No keys in {dimension.table} for {missing[:10]}'
+        keys.update(new_keys)
+
+    def encode(self, db_session, df):
+        """
+        Замена текстовых колонок продаж на ключи измерений
+        :param db_session: Подключение к БД
+        :param df: Продажи с индексом code и колонками branch, name, client
+        :return df {DataFrame}: Продажи с колонками shop_id, sku_id, client_id вместо текстовых
+        """
+        df = df.reset_index()
+        with self._lock:
+            for dimension in self.DIMENSIONS:
+                self._add_members_(db_session, dimension, df)
+                keys = self.keys[dimension.table]
+                df[dimension.id_column] = df[dimension.key_column].astype(object).map(keys).astype('int32')
+
+        return df.drop(columns=[column for dimension in self.DIMENSIONS
+                                for column in (dimension.key_column, *dimension.attributes)])
+
+
+def downcast_float(series, tolerance=0.005):
+    """
+    Перевод колонки в float32, если это не меняет значения больше чем на tolerance (полкопейки для денег).
+    Иначе колонка остается float64.
+    """
+    downcasted = series.astype('float32')
+    if np.allclose(downcasted.to_numpy(dtype='float64'), series.to_numpy(dtype='float64'),
+                   rtol=0, atol=tolerance, equal_nan=True):
+        return downcasted
+    return series
+
+
+def compact_frame(df, categories, floats):
+    """
+    Компактное представление продаж в памяти: текстовые колонки в category, числовые в float32 где возможно
+    :param categories: Текстовые колонки
+    :param floats: Числовые колонки
+    """
+    for column in categories:
+        df[column] = df[column].astype('category')
+    for column in floats:
+        df[column] = downcast_float(pd.to_numeric(df[column]))
+    return df
+
+
+class NameLookup:
+    """
+    Кэш наименований по кодам (например, справочника 1С). Наименования запрашиваются только для кодов,
+    которых еще нет в кэше, поэтому при выгрузке по окнам и частям каждый код запрашивается один раз.
+    """
+
+    def __init__(self, fetch):
+        """
+        :param fetch: Функция, которая по множеству кодов возвращает {код: наименование}
+        """
+        self.fetch = fetch
+        self.names = {}
+        self._lock = threading.Lock()
+
+    def map(self, codes):
+        """
+        Наименования для колонки кодов
+        :param codes: pd.Series с кодами
+        :return pd.Series: Наименования
+        """
+        with self._lock:
+            missing = set(codes.unique()) - self.names.keys()
+            if missing:
+                logging.info(f'Getting {len(missing)} names')
+                # Коды без наименования тоже запоминаются, чтобы не запрашивать их повторно
+                self.names.update(dict.fromkeys(missing))
+                self.names.update(self.fetch(missing))
+
+            # Под блокировкой: другой поток может дописывать словарь, пока pandas его читает
+            return codes.map(self.names)
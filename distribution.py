@@ -1,12 +1,58 @@
 import pandas as pd
+import numpy as np
 import datetime
-from connectors.connection import create_rarus_connection, create_sql02_connection
+import hashlib
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from connection_manager import default_manager
+from dimensions import DimensionStore, NameLookup, compact_frame
+from loaders import ExecuteManyLoader, StagingTableLoader
+from metrics import RunMetrics, measure_iter
+from pipeline import Pipeline
+from rollups import RollupStore
+from state import CodeIndex, WatermarkStore
 import logging
 
 logging.basicConfig(filename=f"./logs/log_{datetime.date.today().strftime('%d-%m-%Y')}",
                     format='%(asctime)s: %(message)s', level=logging.DEBUG)
 
 
+def iter_selection_chunks(sel, get_row, chunk_size=None):
+    """
+    Чтение выборки 1С частями. Выборка читается через sel.next() и отдается списками строк по chunk_size штук,
+    поэтому в памяти одновременно находится не больше одной части.
+
+    :param sel: Выборка из 1С (query.Execute().Choose())
+    :param get_row: Функция, которая из текущей строки выборки делает tuple
+    :param chunk_size: Размер части. Если None, то вся выборка отдается одной частью
+    :return generator of [()]:
+    """
+    chunk = []
+    while sel.next():
+        chunk.append(get_row(sel))
+        if chunk_size and len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class SelectionChunk(list):
+    """
+    Часть выборки 1С вместе со статистикой запроса (DistributionSales.extract_stats), из которого она получена.
+    Этап преобразования может выполняться в другом потоке (pipeline), поэтому статистика передается вместе с частью.
+    """
+
+    def __init__(self, rows=(), extract=None):
+        super().__init__(rows)
+        self.extract = extract
+
+
 class DistributionGoods:
     """
 
@@ -24,6 +70,8 @@ class DistributionGoods:
 
     """
     DB_TABLE_NAME = 'ANALITYCS.dbo.DistributionGoods'
+    # Менеджер подключений к БД и 1С (connection_manager.ConnectionManager)
+    connections = default_manager
     # Список поставщиков дистрибуции и их бренды
     DISTRIBUTION_SUPPLIERS_BRANDS = {
         'DR002218': 'ROZMETOV',
@@ -40,13 +88,62 @@ class DistributionGoods:
         'DR002219': 'SVITLOGORIE'
     }
 
+    def __init__(self, chunk_size=None, loader=None, incremental=False, watermarks=None, code_index=None, cache=None,
+                 pipelined=False, queue_size=2, metrics=None):
+        """
+        Если incremental == True, то вместо исключения всех кодов из БД в тексте запроса (НЕ ... В (...))
+            1. Из 1С получаются только согласования цен, период которых >= водяного знака поставщика
+            2. Уже известные кода товаров исключаются на стороне python по индексу кодов
+            3. После записи в БД водяные знаки сдвигаются на максимальный полученный период по поставщику
+        Размер запроса в 1С не зависит от количества товаров в БД.
+
+        :param chunk_size: Если задан, то товары из 1С читаются и записываются в БД частями по chunk_size строк
+        :param loader: Загрузчик в БД из loaders. По умолчанию ExecuteManyLoader
+        :param incremental: Инкрементальная выгрузка по водяным знакам
+        :param watermarks: Хранилище водяных знаков state.WatermarkStore. По умолчанию ./state/goods_watermarks.json
+        :param code_index: Индекс известных кодов state.CodeIndex. По умолчанию в памяти, заполняется из БД
+        :param cache: Кэш выгрузок cache.ExtractCache. Полученные из 1С товары сохраняются в кэш за день выгрузки
+            (кроме pipelined). С chunk_size части собираются в один файл: в частях только новые товары
+        :param pipelined: Выгрузка из 1С, преобразование и запись в БД частями по chunk_size выполняются одновременно
+            в отдельных потоках (pipeline.Pipeline)
+        :param queue_size: Размер очередей между этапами конвейера
+        :param metrics: Метрики запуска metrics.RunMetrics. По умолчанию пишутся в ./logs
+        """
+        self.chunk_size = chunk_size
+        self.metrics = metrics or RunMetrics('goods')
+        self.loader = loader or ExecuteManyLoader()
+        self.incremental = incremental
+        self.cache = cache
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.pipeline_stats = []
+        if incremental:
+            self.watermarks = watermarks or WatermarkStore()
+            self.code_index = code_index or CodeIndex()
+
     def __call__(self):
         added_skus = 0
-        res = self.get_brands_skus_from_rarus()
-        if not res.empty:
-            added_skus = self._add_goods_to_db(res)
+        if self.pipelined:
+            added_skus = self._run_pipeline_()
+        elif self.chunk_size:
+            for df in self.iter_brands_skus_from_rarus():
+                if not df.empty:
+                    added_skus += self._add_goods_to_db(df)
+        else:
+            res = self.get_brands_skus_from_rarus()
+            if not res.empty:
+                added_skus = self._add_goods_to_db(res)
+
+        if self.incremental:
+            # Водяные знаки и индекс сохраняются только после успешной записи всех товаров
+            self.watermarks.save()
+            self.code_index.save()
 
-        logging.info('**** ADDED SKUS: ', added_skus)
+        logging.info(f'**** ADDED SKUS: {added_skus}')
+        self.metrics.set_info('added_skus', added_skus)
+        self.metrics.set_info('connections', self.connections.stats())
+        self.metrics.set_info('pipeline', self.pipeline_stats)
+        self.metrics.write()
 
     @staticmethod
     def convert_to_string(codes) -> str:
@@ -76,13 +173,25 @@ class DistributionGoods:
         """
         logging.info('Getting goods code from db..')
         logging.info('loading session..')
-        db_session = create_sql02_connection()
-        logging.info('Executing query..')
-        result = db_session.execute(f"Select code from {cls.DB_TABLE_NAME}").fetchall()
-        db_session.close()
+        with cls.connections.sql() as db_session:
+            logging.info('Executing query..')
+            result = db_session.execute(f"Select code from {cls.DB_TABLE_NAME}").fetchall()
 
         return result
 
+    @classmethod
+    def get_goods_names_from_db(cls, codes=None):
+        """
+        Наименования товаров из БД таблицы DistributionGoods
+        :param codes: Кода товаров. Если не переданы, то все товары
+        :return names -> dict: {code: name}
+        """
+        logging.info('Getting goods names from db..')
+        with cls.connections.sql() as db_session:
+            result = db_session.execute(f"Select code, name from {cls.DB_TABLE_NAME}").fetchall()
+
+        return {code: name for code, name in result if codes is None or code in codes}
+
     @classmethod
     def get_db_goods_codes_in_rarus_format(cls) -> str:
         """
@@ -97,11 +206,10 @@ class DistributionGoods:
 
         return codes_str
 
-    def get_brands_skus_from_rarus(self):
+    def _build_goods_query_(self):
         """
-        Получим из 1С товары, которые принадлежат постащвикам дистрибуции, но которых еще нет в БД.
-        Установим бренд из DISTRIBUTION_SUPPLIERS_BRANDS по SupplierCode-у из результата запроса
-        :return df {DataFrame}: Данные по 1С коду товара, названию товара,  названиям поставщика из 1С и Бренду
+        Текст запроса товаров поставщиков дистрибуции, которых еще нет в БД
+        :return qry_suppl_skus -> str:
         """
         logging.info('Getting brands suppliers codes')
         r_supplier_codes = self.convert_to_string(self.DISTRIBUTION_SUPPLIERS_BRANDS.keys())
@@ -142,47 +250,243 @@ class DistributionGoods:
                 СогласованиеЦенСрезПоследних.Контрагент.Наименование
             """
 
+        return qry_suppl_skus
+
+    def _build_incremental_goods_query_(self):
+        """
+        Текст запроса товаров по согласованиям цен новее водяных знаков поставщиков.
+        Кода товаров в запрос не передаются, поэтому размер запроса зависит только от количества поставщиков.
+        Как и в полном запросе, для каждого товара берется только последнее согласование (МаксДаты), поэтому товар
+        не приходит в разных частях chunk_size с разными поставщиками. Результат упорядочен по коду и периоду.
+        :return qry_suppl_skus -> str:
+        """
+        conditions = []
+        for supplier_code in self.DISTRIBUTION_SUPPLIERS_BRANDS:
+            watermark = self.watermarks.get(supplier_code)
+            if watermark:
+                conditions.append(f'СогласованиеЦенСрезПоследних.Контрагент.Код = "{supplier_code}" '
+                                  f'И СогласованиеЦенСрезПоследних.Период >= '
+                                  f'ДАТАВРЕМЯ({watermark.strftime("%Y, %m, %d, %H, %M, %S")})')
+            else:
+                conditions.append(f'СогласованиеЦенСрезПоследних.Контрагент.Код = "{supplier_code}"')
+        r_conditions = '\n                ИЛИ '.join(f'({condition})' for condition in conditions)
+        r_inner_conditions = '\n                        ИЛИ '.join(f'({condition})' for condition in conditions)
+
+        qry_suppl_skus = f"""
+            ВЫБРАТЬ
+                СогласованиеЦенСрезПоследних.Номенклатура.Код КАК Code,
+                СогласованиеЦенСрезПоследних.Номенклатура.Наименование КАК Name,
+                СогласованиеЦенСрезПоследних.Контрагент.Код КАК SupplierCode,
+                СогласованиеЦенСрезПоследних.Контрагент.Наименование КАК Supplier,
+                СогласованиеЦенСрезПоследних.Период КАК Period
+            ИЗ
+                РегистрСведений.СогласованиеЦен.СрезПоследних КАК СогласованиеЦенСрезПоследних
+                    ВНУТРЕННЕЕ СОЕДИНЕНИЕ (ВЫБРАТЬ
+                        МАКСИМУМ(СогласованиеЦенСрезПоследних.Период) КАК Период,
+                        СогласованиеЦенСрезПоследних.Номенклатура КАК Номенклатура
+                    ИЗ
+                        РегистрСведений.СогласованиеЦен.СрезПоследних КАК СогласованиеЦенСрезПоследних
+                    ГДЕ
+                        {r_inner_conditions}
+
+                    СГРУППИРОВАТЬ ПО
+                        СогласованиеЦенСрезПоследних.Номенклатура) КАК МаксДаты
+                    ПО СогласованиеЦенСрезПоследних.Номенклатура = МаксДаты.Номенклатура
+                        И СогласованиеЦенСрезПоследних.Период = МаксДаты.Период
+            ГДЕ
+                {r_conditions}
+
+            СГРУППИРОВАТЬ ПО
+                СогласованиеЦенСрезПоследних.Номенклатура.Наименование,
+                СогласованиеЦенСрезПоследних.Номенклатура.Код,
+                СогласованиеЦенСрезПоследних.Контрагент.Код,
+                СогласованиеЦенСрезПоследних.Контрагент.Наименование,
+                СогласованиеЦенСрезПоследних.Период
+
+            УПОРЯДОЧИТЬ ПО
+                Code,
+                Period
+            """
+
+        return qry_suppl_skus
+
+    @staticmethod
+    def _to_datetime_(value):
+        """
+        Дата из 1С (pywintypes.datetime с часовым поясом) в datetime.datetime без часового пояса
+        """
+        return datetime.datetime(value.year, value.month, value.day, value.hour, value.minute, value.second)
+
+    def _iter_brands_skus_rows_(self):
+        """
+        Выполнение запроса товаров в 1С и чтение результата частями по self.chunk_size строк
+        :return generator of [()]:
+        """
+        with self.metrics.stage('goods.query_build'):
+            if self.incremental:
+                self.code_index.load(lambda: [code[0] for code in self.get_goods_codes_from_db()])
+                qry_suppl_skus = self._build_incremental_goods_query_()
+            else:
+                qry_suppl_skus = self._build_goods_query_()
+
+        if self.incremental:
+            get_row = lambda x: (x.Code, x.Name, x.Supplier, self.DISTRIBUTION_SUPPLIERS_BRANDS.get(x.SupplierCode),
+                                 x.SupplierCode, self._to_datetime_(x.Period))
+        else:
+            get_row = lambda x: (x.Code, x.Name, x.Supplier, self.DISTRIBUTION_SUPPLIERS_BRANDS.get(x.SupplierCode))
+
         logging.info('Getting rarus connector')
-        rarus_connector = create_rarus_connection()
-        logging.info('Getting data from RARUS')
-        query = rarus_connector.NewObject("Query", qry_suppl_skus)
-        sel = query.Execute().Choose()  # Get result of RARUS query
+        with self.connections.rarus() as rarus_connector, self.metrics.stage('goods.rarus_execute'):
+            logging.info('Getting data from RARUS')
+            query = rarus_connector.NewObject("Query", qry_suppl_skus)
+            sel = query.Execute().Choose()  # Get result of RARUS query
 
-        del rarus_connector
+        yield from measure_iter(iter_selection_chunks(sel, get_row, self.chunk_size), self.metrics,
+                                'goods.row_iteration')
 
-        data = []
-        while sel.next():
-            data.append((sel.Code, sel.Name, sel.Supplier, self.DISTRIBUTION_SUPPLIERS_BRANDS.get(sel.SupplierCode)))
+    def _filter_new_goods_(self, df):
+        """
+        Инкрементальный режим: сдвигаем водяные знаки поставщиков по полученным согласованиям и исключаем товары,
+        которые уже есть в индексе кодов. Последнее согласование товара по всем поставщикам выбирает запрос
+        (_build_incremental_goods_query_), поэтому товар не может прийти в следующей части с более новым
+        согласованием. Строки одного товара с одинаковым последним периодом схлопываются в одну.
+        :param df: Товары из 1С с колонками supplier_code и period
+        :return df {DataFrame}: Только новые товары, без служебных колонок
+        """
+        for supplier_code, period in df.groupby('supplier_code')['period'].max().items():
+            self.watermarks.advance(supplier_code, period)
 
+        df = df.sort_values('period', kind='stable')
+        df = df[~df.index.duplicated(keep='last') & ~df.index.isin(self.code_index.codes)]
+        self.code_index.add(df.index)
+
+        logging.info(f'New goods after filtering by code index: {len(df)}')
+        return df.drop(columns=['supplier_code', 'period'])
+
+    def _goods_rows_to_df_(self, data):
+        """
+        Преобразование строк товаров из 1С в pd.Dataframe
+        """
         # ! Важно не менять название колонок, т.к по ним в дальнейшем будет выгрузка данных в БД.
         # Данные названия - это названия соотвествующих столбцов в таблице DistributionGoods в БД
         logging.info('Converting RARUS data to pd.Dataframe')
-        df = pd.DataFrame(data, columns=['code', 'name', 'supplier_name', 'brand']).set_index('code')
-        df['log_date'] = datetime.datetime.now()
+        with self.metrics.stage('goods.dataframe_build') as stage:
+            columns = ['code', 'name', 'supplier_name', 'brand']
+            if self.incremental:
+                columns += ['supplier_code', 'period']
+            df = pd.DataFrame(data, columns=columns).set_index('code')
+            if self.incremental:
+                df = self._filter_new_goods_(df)
+            df['log_date'] = datetime.datetime.now()
+            stage.rows = len(df)
+        return df
+
+    def iter_brands_skus_from_rarus(self):
+        """
+        Потоковый вариант get_brands_skus_from_rarus: товары отдаются частями по self.chunk_size строк
+        :return generator of DataFrame:
+        """
+        frames = []
+        for data in self._iter_brands_skus_rows_():
+            df = self._goods_rows_to_df_(data)
+            if self.cache:
+                frames.append(df)
+            yield df
+
+        if frames:
+            self.cache.write_day('goods', datetime.date.today(), pd.concat(frames))
+
+    def get_brands_skus_from_rarus(self):
+        """
+        Получим из 1С товары, которые принадлежат постащвикам дистрибуции, но которых еще нет в БД.
+        Установим бренд из DISTRIBUTION_SUPPLIERS_BRANDS по SupplierCode-у из результата запроса
+        :return df {DataFrame}: Данные по 1С коду товара, названию товара,  названиям поставщика из 1С и Бренду
+        """
+        data = [row for chunk in self._iter_brands_skus_rows_() for row in chunk]
+        df = self._goods_rows_to_df_(data)
+        if self.cache:
+            self.cache.write_day('goods', datetime.date.today(), df)
         logging.info('Finished. Returning rarus brands skus')
         return df
 
-    @classmethod
-    def _add_goods_to_db(cls, df):
+    def reload_from_cache(self, start_date, end_date):
+        """
+        Запись в БД товаров из кэша за дни выгрузки периода без запроса в 1С.
+        Товары, которые уже есть в БД, не записываются.
+        :return: Number of added goods to DB table
+        """
+        assert self.cache, 'Cache is not set'
+        db_codes = {code[0] for code in self.get_goods_codes_from_db()}
+        frames = [self.cache.read_day('goods', day) for day in self.cache.days(start_date, end_date)
+                  if self.cache.is_fresh('goods', day)]
+        frames = [df for df in frames if df is not None]
+        if not frames:
+            logging.warning(f'No cached goods for the period {start_date} - {end_date}')
+            return 0
+
+        df = pd.concat(frames)
+        df = df[~df.index.isin(db_codes) & ~df.index.duplicated(keep='last')]
+        if df.empty:
+            return 0
+        df['log_date'] = datetime.datetime.now()
+        return self._add_goods_to_db(df)
+
+    def _run_pipeline_(self):
+        """
+        Конвейер: чтение частей из 1С -> pd.Dataframe -> запись в БД
+        :return: Number of added goods to DB table
+        """
+        added_skus = []
+        pipeline = Pipeline(self._iter_brands_skus_rows_,
+                            [('transform', self._goods_rows_to_df_),
+                             ('load', lambda df: added_skus.append(self._add_goods_to_db(df) if not df.empty else 0))],
+                            maxsize=self.queue_size, thread_context=self.connections.rarus_thread)
+        self.pipeline_stats = pipeline.run()
+        return sum(added_skus)
+
+    def _add_goods_to_db(self, df):
         """
         Сохранение данных в таблицу БД.
         :param df: Данные по товарам поставщиков дистрибуции и брендам
         :return: Number of added goods to DB table
         """
         logging.info('Adding goods to db table')
-        db_session = create_sql02_connection()
-        df.to_sql(cls.DB_TABLE_NAME, db_session.cursor(), if_exists='append')
-        db_session.commit()
-        db_session.close()
+        with self.connections.sql() as db_session, self.metrics.stage('goods.load') as stage:
+            rows = stage.rows = self.loader.load(db_session, self.DB_TABLE_NAME, df)
 
-        logging.info(f'Finished. Added {len(df)} goods')
-        return len(df)
+        logging.info(f'Finished. Added {rows} goods')
+        return rows
 
 
 class DistributionSales:
     DB_TABLE_NAME = 'Analitycs.dbo.DistributionSales'
+    # Таблица продаж компактного режима: вместо текстов ключи измерений dimensions.DimensionStore.DIMENSIONS
+    COMPACT_DB_TABLE_NAME = 'Analitycs.dbo.DistributionSalesCompact'
+    # Менеджер подключений к БД и 1С (connection_manager.ConnectionManager)
+    connections = default_manager
+    # Допустимые размеры окон, на которые делится период выгрузки
+    WINDOWS = ('day', 'week', 'month')
+    # Профили запроса продаж:
+    #   full - наименования и маржа считаются в 1С
+    #   lean - из 1С только кода и суммы, маржа считается в python, наименования из кэша справочников
+    PROFILES = ('full', 'lean')
+    # Справочники 1С для наименований в профиле lean
+    SHOPS_CATALOG = 'ПодразделенияКомпании'
+    CUSTOMERS_CATALOG = 'Контрагенты'
+    # Правила определения клиента (см. _get_customer_). Применяется первое подходящее правило:
+    # если значение column равно equals, то клиент = значение колонки client_from или строка client.
+    # Если ни одно правило не подошло, то клиент = client из 1С
+    CUSTOMER_RULES = (
+        {'column': 'client_code', 'equals': '00000003', 'client_from': 'branch'},  # частное лицо
+        {'column': 'branch', 'equals': 'ДМ АШАН', 'client': 'B2B'},
+    )
+    # Контрольные суммы сверки с 1С по дню и подразделению (см. reconcile) и допустимое расхождение
+    CONTROL_COLUMNS = ('quantity_sold', 'turnover', 'cogs')
+    RECONCILE_TOLERANCE = 0.01
 
-    def __init__(self, append=True):
+    def __init__(self, append=True, window=None, workers=1, chunk_size=None, loader=None, cache=None,
+                 pipelined=False, queue_size=2, compact=False, profile='full', start_date=None, end_date=None,
+                 metrics=None, swap=False, resync_days=0, checkpoint=None, interactive=True, rollups=False):
         """
         Если append == False, тогда
             1. У Пользователя запращивается периода анализа.
@@ -197,28 +501,120 @@ class DistributionSales:
             3. Получаются данные по продажам из 1С по данному периоду
             4. Сохранение в БД данных о продажах
 
+        Если задан window, то период анализа делится на окна (день/неделя/месяц) и каждое окно запрашивается из 1С
+        отдельным запросом на своем подключении. Одновременно выполняется не более workers запросов.
+
         :param append: Дополнять продажи или получить продажи за определенный период
+        :param window: Размер окна выгрузки: 'day', 'week', 'month' или None (весь период одним запросом)
+        :param workers: Количество одновременных подключений к 1С при выгрузке по окнам
+        :param chunk_size: Если задан, то продажи читаются из 1С, обрабатываются и записываются в БД частями
+            по chunk_size строк. Память зависит от размера части, а не от длины периода
+        :param loader: Загрузчик в БД из loaders. По умолчанию ExecuteManyLoader
+        :param cache: Кэш выгрузок cache.ExtractCache. Дни, которые есть в кэше, не запрашиваются из 1С повторно.
+            Дни, выгруженные с другим профилем или списком товаров (_cache_fingerprint_), выгружаются заново
+        :param pipelined: Выгрузка из 1С, преобразование и запись в БД выполняются одновременно в отдельных потоках
+            (pipeline.Pipeline): пока пишется часть N, из 1С читается часть N+1. Части - по chunk_size строк
+            внутри окна. Окна читаются из 1С по очереди, workers и cache не используются
+        :param queue_size: Размер очередей между этапами конвейера
+        :param compact: Компактный режим. В памяти branch, name, client хранятся как category, числовые колонки
+            в float32 где это не теряет точность. В БД продажи пишутся в COMPACT_DB_TABLE_NAME с целочисленными
+            ключами подразделения, товара и клиента, а сами значения в таблицы измерений
+        :param profile: Профиль запроса продаж из PROFILES. Результат у профилей одинаковый
+        :param start_date: Дата начала анализа. Если заданы обе даты, то период у пользователя не запрашивается
+        :param end_date: Дата конца анализа
+        :param metrics: Метрики запуска metrics.RunMetrics. По умолчанию пишутся в ./logs
+        :param swap: Идемпотентная запись. Продажи окна пишутся в staging таблицу и заменяют продажи окна в БД одной
+            транзакцией (loaders.WindowSwap), отдельного удаления периода нет. Повторный или пересекающийся запуск
+            не дублирует строки, а сбой не оставляет частично записанное окно. Нужен loaders.StagingTableLoader
+        :param resync_days: Только для append и swap. Последние resync_days дней из БД выгружаются заново вместе
+            с новыми днями и заменяются в той же транзакции, что и первое окно новых дней (первое окно
+            расширяется назад на дни повторной синхронизации)
+        :param checkpoint: Выполненные окна state.WindowCheckpoint. Окна из checkpoint пропускаются, каждое
+            записанное окно сразу сохраняется в checkpoint. Только для потоковой выгрузки (chunk_size) и swap
+        :param interactive: Если False, то период не запрашивается через input(), а без дат выгрузка падает
+        :param rollups: После записи продаж пересчитываются периоды агрегатов rollups.RollupStore, в которые попали
+            записанные дни (по окну, а при прямом вызове save_to_db - по дням записанной части)
         """
+        assert window is None or window in self.WINDOWS, f'Wrong window. Use one of {self.WINDOWS}'
+        assert profile in self.PROFILES, f'Wrong profile. Use one of {self.PROFILES}'
+        assert workers >= 1, 'Workers must be >= 1'
+        assert not (pipelined and cache), 'Cache is not supported in pipelined mode'
+        assert not (pipelined and swap), 'Swap is not supported in pipelined mode'
+        assert resync_days >= 0, 'Resync days must be >= 0'
+        assert not resync_days or swap, 'Rolling re-sync requires swap'
+        assert not checkpoint or (chunk_size and swap and not pipelined), 'Checkpoint requires chunk_size and swap'
         self.append = append
+        self.metrics = metrics or RunMetrics('sales')
+        self.start_date = start_date
+        self.end_date = end_date
+        self.window = window
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.loader = loader or (StagingTableLoader() if swap else ExecuteManyLoader())
+        assert not swap or isinstance(self.loader, StagingTableLoader), 'Swap requires StagingTableLoader'
+        self.swap = swap
+        self.resync_days = resync_days
+        # Последний день повторной синхронизации (максимальная дата в БД), если она есть
+        self.resync_end_date = None
+        self.checkpoint = checkpoint
+        self.interactive = interactive
+        self.cache = cache
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.compact = compact
+        self.profile = profile
+        if profile == 'lean':
+            self.shops = NameLookup(lambda codes: self._get_rarus_names_(self.SHOPS_CATALOG, codes))
+            self.customers = NameLookup(lambda codes: self._get_rarus_names_(self.CUSTOMERS_CATALOG, codes))
+            self.skus = NameLookup(DistributionGoods.get_goods_names_from_db)
+        # Статистика запросов в 1С: профиль, время выполнения запроса, количество строк и байт
+        self.extract_stats = []
+        if compact:
+            # Удаление, максимальная дата и запись идут по компактной таблице
+            self.DB_TABLE_NAME = self.COMPACT_DB_TABLE_NAME
+            self.dimensions = DimensionStore(self.loader)
+        self.rollups = RollupStore(self.DB_TABLE_NAME, DistributionGoods.DB_TABLE_NAME, compact,
+                                   self.loader.dialect) if rollups else None
+        self.windows_stats = []
+        self.pipeline_stats = []
 
     def __call__(self):
         if not self.append:
-            self._get_dates_from_user()
-            self._delete_from_db_table()
+            if not (self.start_date and self.end_date):
+                self._get_dates_from_user()
+            if not self.swap:
+                self._delete_from_db_table()
         else:
             max_date_from_db = self._get_max_sales_date_()
             if not max_date_from_db:
-                self._get_dates_from_user()
+                if not (self.start_date and self.end_date):
+                    self._get_dates_from_user()
             else:
-                self.start_date = max_date_from_db + datetime.timedelta(days=1)
+                self.start_date = max_date_from_db + datetime.timedelta(days=1 - self.resync_days)
+                if self.resync_days:
+                    self.resync_end_date = max_date_from_db
                 self.end_date = datetime.date.today() - datetime.timedelta(days=2)
 
                 if self.start_date > self.end_date:
                     print(f'{self.start_date} > {self.end_date}')
                     return
 
-        df = self._get_sales_()
-        self.save_to_db(df)
+        if self.pipelined:
+            self._run_pipeline_()
+        elif self.chunk_size:
+            self._stream_sales_to_db_()
+        else:
+            if self.window:
+                df = self._get_sales_windowed_()
+            else:
+                df = self._get_sales_()
+            self._save_window_(df, self.start_date, self.end_date)
+        self.metrics.set_info('period', [self.start_date, self.end_date])
+        self.metrics.set_info('connections', self.connections.stats())
+        self.metrics.set_info('windows', self.windows_stats)
+        self.metrics.set_info('pipeline', self.pipeline_stats)
+        self.metrics.set_info('extract', self.extract_stats)
+        self.metrics.write()
         print('Done!..')
 
     def _get_dates_from_user(self):
@@ -227,6 +623,7 @@ class DistributionSales:
         Затем идет проверка на корректность пользовательских дат
         :return:
         """
+        assert self.interactive, 'Sales period is not set. Pass start_date and end_date'
         logging.info('Getting dates from the user')
         start_date = input('Please input start date in YYYY-MM-DD format: ')
         end_date = input('Please input end date in YYYY-MM-DD format: ')
@@ -240,17 +637,20 @@ class DistributionSales:
             logging.error(err)
             raise err
 
-    def _delete_from_db_table(self):
+    def _delete_from_db_table(self, start_date=None, end_date=None):
         """
         Удаление данных о продажах за периода анализа из БД
+        :param start_date: Дата начала. По умолчанию дата начала анализа
+        :param end_date: Дата конца. По умолчанию дата конца анализа
         :return:
         """
-        logging.info(f'Delete sales data for the period {self.start_date} - {self.end_date}')
-        db_session = create_sql02_connection()
-        qry = f"Delete from {self.DB_TABLE_NAME} where date_ between '{self.start_date}' and '{self.end_date}'"
-        db_session.execute(qry)
-        db_session.commit()
-        db_session.close()
+        start_date = start_date or self.start_date
+        end_date = end_date or self.end_date
+        logging.info(f'Delete sales data for the period {start_date} - {end_date}')
+        with self.connections.sql() as db_session, self.metrics.stage('sales.delete'):
+            qry = f"Delete from {self.DB_TABLE_NAME} where date_ between '{start_date}' and '{end_date}'"
+            db_session.execute(qry)
+            db_session.commit()
         logging.info('Finished!')
 
     def _get_max_sales_date_(self):
@@ -259,9 +659,8 @@ class DistributionSales:
         :return max_date: Самая последняя дата в БД таблице
         """
         logging.info('Getting last date from sales table')
-        db_session = create_sql02_connection()
-        res = db_session.execute(f"select max(date_) from {self.DB_TABLE_NAME}").fetchone()
-        db_session.close()
+        with self.connections.sql() as db_session:
+            res = db_session.execute(f"select max(date_) from {self.DB_TABLE_NAME}").fetchone()[0]
 
         logging.info(f'Max sales date in the sales table {res}')
         return res
@@ -272,29 +671,76 @@ class DistributionSales:
         :return bool: True если есть иначе False
         """
         logging.info('Checking if table contains any sales data ')
-        db_session = create_sql02_connection()
-        res = db_session.execute(f"select max(id) from {self.DB_TABLE_NAME}").fetchone()
-        db_session.close()
+        with self.connections.sql() as db_session:
+            res = db_session.execute(f"select max(id) from {self.DB_TABLE_NAME}").fetchone()
 
         logging.info(f'Finished. Result: {bool(res)}')
         return bool(res)
 
-    def _get_sales_(self):
+    def _get_db_control_totals_(self, start_date, end_date):
+        """
+        Контрольные суммы продаж из БД по дню и подразделению
+        :return df {DataFrame}: Колонки date_, branch и CONTROL_COLUMNS
         """
+        totals = ', '.join(f'sum(sales.{column})' for column in self.CONTROL_COLUMNS)
+        if self.compact:
+            shops = DimensionStore.DIMENSIONS[0]
+            qry = f"""
+            select sales.date_, shops.{shops.key_column}, {totals}
+            from {self.DB_TABLE_NAME} sales
+                join {shops.table} shops on shops.{shops.id_column} = sales.{shops.id_column}
+            where sales.date_ between '{start_date}' and '{end_date}'
+            group by sales.date_, shops.{shops.key_column}
+            """
+        else:
+            qry = f"""
+            select sales.date_, sales.branch, {totals}
+            from {self.DB_TABLE_NAME} sales
+            where sales.date_ between '{start_date}' and '{end_date}'
+            group by sales.date_, sales.branch
+            """
 
-        По периоду аналиаза получаем данные о продаж из 1С.
-        Сначала получим все 1С кода товаров дистрибуции из БД таблицы DistributionGoods и затем отфильтруем продажи
-        по полученным 1С кодам.
+        logging.info(f'Getting control totals from db for the period {start_date} - {end_date}')
+        with self.connections.sql() as db_session, self.metrics.stage('sales.control_totals_db') as stage:
+            data = [tuple(row) for row in db_session.execute(qry).fetchall()]
+            stage.rows = len(data)
 
-        :return df {DataFrame}: данные по продажам за периоджд
+        return pd.DataFrame(data, columns=['date_', 'branch', *self.CONTROL_COLUMNS])
+
+    @staticmethod
+    def _split_period_(start_date, end_date, window):
         """
-        logging.info(f'Getting sales from RARUS for the period {self.start_date} - {self.end_date}')
-        da1 = self.start_date.strftime('%Y, %m, %d')
-        date_begin = f'ДАТАВРЕМЯ({da1}, 00, 00, 01)'
-        da2 = self.end_date.strftime('%Y, %m, %d')
-        date_end = f'ДАТАВРЕМЯ({da2}, 23, 59, 05)'
+        Разбивка периода анализа на окна. Окна недели и месяца выравниваются по календарю:
+        неделя с понедельника, месяц с первого числа. Первое и последнее окна обрезаются по границам периода.
 
-        r_sku_codes = DistributionGoods.get_db_goods_codes_in_rarus_format()
+        :param start_date: Дата начала периода
+        :param end_date: Дата конца периода
+        :param window: 'day', 'week' или 'month'
+        :return windows -> [(date, date)]: Список окон (начало, конец) включительно
+        """
+        windows = []
+        current = start_date
+        while current <= end_date:
+            if window == 'day':
+                window_end = current
+            elif window == 'week':
+                window_end = current + datetime.timedelta(days=6 - current.weekday())
+            else:
+                next_month = (current.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+                window_end = next_month - datetime.timedelta(days=1)
+            window_end = min(window_end, end_date)
+            windows.append((current, window_end))
+            current = window_end + datetime.timedelta(days=1)
+
+        return windows
+
+    def _get_rarus_sku_codes_(self):
+        """
+        Получим 1С кода товаров дистрибуции из БД таблицы DistributionGoods для фильтра запроса продаж
+        :return string of codes: "code1", "code2" .. "codeN"
+        """
+        with self.metrics.stage('sales.goods_codes'):
+            r_sku_codes = DistributionGoods.get_db_goods_codes_in_rarus_format()
 
         try:
             assert r_sku_codes, 'Goods db table is empty'
@@ -302,6 +748,29 @@ class DistributionSales:
             logging.error('Goods db table is empty')
             raise err
 
+        return r_sku_codes
+
+    @staticmethod
+    def _rarus_period_(start_date, end_date):
+        """
+        Границы периода в формате запроса 1С
+        :return (date_begin, date_end):
+        """
+        da1 = start_date.strftime('%Y, %m, %d')
+        date_begin = f'ДАТАВРЕМЯ({da1}, 00, 00, 01)'
+        da2 = end_date.strftime('%Y, %m, %d')
+        date_end = f'ДАТАВРЕМЯ({da2}, 23, 59, 05)'
+        return date_begin, date_end
+
+    def _build_sales_query_(self, start_date, end_date, r_sku_codes):
+        """
+        Текст запроса продаж из 1С за период
+        :return qry_sales -> str:
+        """
+        date_begin, date_end = self._rarus_period_(start_date, end_date)
+        if self.profile == 'lean':
+            return self._build_lean_sales_query_(date_begin, date_end, r_sku_codes)
+
         qry_sales = f"""
         ВЫБРАТЬ
             ПродажиОбороты.ПодразделениеКомпании.Наименование КАК Shop,
@@ -345,28 +814,518 @@ class DistributionSales:
             Date_
         """
 
-        logging.info('Creating connection to RARUS')
-        rarus_connector = create_rarus_connection()
+        return qry_sales
+
+    @staticmethod
+    def _build_lean_sales_query_(date_begin, date_end, r_sku_codes):
+        """
+        Текст запроса продаж профиля lean: только кода и суммы оборотов без вычислений
+        :return qry_sales -> str:
+        """
+        qry_sales = f"""
+        ВЫБРАТЬ
+            ПродажиОбороты.ПодразделениеКомпании.Код КАК ShopCode,
+            ПродажиОбороты.Период КАК Date_,
+            ПродажиОбороты.Номенклатура.Код КАК Code,
+            ПродажиОбороты.Покупатель.Код КАК CustomerCode,
+            СУММА(ПродажиОбороты.КоличествоОборот) КАК Qty,
+            СУММА(ПродажиОбороты.СуммаОборот) КАК Turnover,
+            СУММА(ПродажиОбороты.СуммаНДСОборот) КАК VAT,
+            СУММА(ПродажиОбороты.СебестоимостьУпрОборот) КАК Cost,
+            СУММА(ПродажиОбороты.СуммаНДСВходящийОборот) КАК VATIn
+
+        ИЗ
+            РегистрНакопления.Продажи.Обороты({date_begin}, {date_end}, День, Номенклатура.Код В ({r_sku_codes}))
+            КАК ПродажиОбороты
+
+        СГРУППИРОВАТЬ ПО
+            ПродажиОбороты.ПодразделениеКомпании.Код,
+            ПродажиОбороты.Период,
+            ПродажиОбороты.Номенклатура.Код,
+            ПродажиОбороты.Покупатель.Код
+
+        УПОРЯДОЧИТЬ ПО
+            Date_
+        """
+
+        return qry_sales
+
+    def _build_control_totals_query_(self, start_date, end_date, r_sku_codes):
+        """
+        Текст запроса контрольных сумм продаж из 1С по дню и подразделению. Фильтр по товарам и расчет
+        себестоимости такие же, как в запросе продаж профиля full
+        :return qry_totals -> str:
+        """
+        date_begin, date_end = self._rarus_period_(start_date, end_date)
+        qry_totals = f"""
+        ВЫБРАТЬ
+            ПродажиОбороты.Период КАК Date_,
+            ПродажиОбороты.ПодразделениеКомпании.Наименование КАК Shop,
+            СУММА(ПродажиОбороты.КоличествоОборот) КАК Qty,
+            СУММА(ПродажиОбороты.СуммаОборот) КАК Turnover,
+            СУММА(ПродажиОбороты.СебестоимостьУпрОборот - ПродажиОбороты.СуммаНДСВходящийОборот) КАК COGS
+
+        ИЗ
+            РегистрНакопления.Продажи.Обороты({date_begin}, {date_end}, День, Номенклатура.Код В ({r_sku_codes}))
+            КАК ПродажиОбороты
+
+        СГРУППИРОВАТЬ ПО
+            ПродажиОбороты.Период,
+            ПродажиОбороты.ПодразделениеКомпании.Наименование
+        """
+
+        return qry_totals
+
+    def _get_rarus_control_totals_(self, start_date, end_date, r_sku_codes):
+        """
+        Контрольные суммы продаж из 1С по дню и подразделению
+        :return df {DataFrame}: Колонки date_, branch и CONTROL_COLUMNS
+        """
+        qry_totals = self._build_control_totals_query_(start_date, end_date, r_sku_codes)
+
+        logging.info(f'Getting control totals from RARUS for the period {start_date} - {end_date}')
+        with self.connections.rarus() as rarus_connector, self.metrics.stage('sales.control_totals_rarus') as stage:
+            query = rarus_connector.NewObject("Query", qry_totals)
+            sel = query.Execute().Choose()
+            data = [row for chunk in iter_selection_chunks(sel, lambda x: (x.Date_.date(), x.Shop, x.Qty, x.Turnover,
+                                                                           x.COGS))
+                    for row in chunk]
+            stage.rows = len(data)
+
+        return pd.DataFrame(data, columns=['date_', 'branch', *self.CONTROL_COLUMNS])
 
-        logging.info('Quering data from RARUS')
-        query = rarus_connector.NewObject("Query", qry_sales)
-        sel = query.Execute().Choose()  # Get result of RARUS query
+    @classmethod
+    def _diff_control_totals_(cls, rarus_totals, db_totals, tolerance):
+        """
+        Сравнение контрольных сумм 1С и БД. Подразделение, которого нет в одной из сторон, считается с нулевыми
+        суммами
+        :return df {DataFrame}: Строки (день, подразделение), у которых хотя бы одна сумма отличается больше
+            чем на tolerance
+        """
+        for totals in (rarus_totals, db_totals):
+            totals['date_'] = pd.to_datetime(totals['date_']).dt.date
+        merged = rarus_totals.merge(db_totals, on=['date_', 'branch'], how='outer', suffixes=('_rarus', '_db'))
+        merged = merged.fillna({column: 0 for column in merged.columns if column not in ('date_', 'branch')})
+        differs = np.zeros(len(merged), dtype=bool)
+        for column in cls.CONTROL_COLUMNS:
+            differs |= ((merged[f'{column}_rarus'] - merged[f'{column}_db']).abs() > tolerance).to_numpy()
+
+        return merged[differs]
+
+    @classmethod
+    def _get_rarus_names_(cls, catalog, codes):
+        """
+        Наименования элементов справочника 1С по кодам
+        :param catalog: Имя справочника 1С
+        :param codes: Кода элементов
+        :return names -> dict: {код: наименование}
+        """
+        qry_names = f"""
+        ВЫБРАТЬ
+            Справочник.Код КАК Code,
+            Справочник.Наименование КАК Name
+        ИЗ
+            Справочник.{catalog} КАК Справочник
+        ГДЕ
+            Справочник.Код В ({DistributionGoods.convert_to_string(codes)})
+        """
 
-        del rarus_connector
-        data = []
-        while sel.next():
-            data.append((sel.Shop, sel.Date_.date(), sel.Code, sel.Name, sel.Qty, sel.Turnover, sel.Turnover_wo_vat,
-                         sel.COGS, sel.Margin, sel.Margin_percent, sel.CustomerCode, sel.Customer))
+        with cls.connections.rarus() as rarus_connector:
+            query = rarus_connector.NewObject("Query", qry_names)
+            sel = query.Execute().Choose()
 
+        return {code: name for chunk in iter_selection_chunks(sel, lambda x: (x.Code, x.Name)) for code, name in chunk}
+
+    def _iter_sales_rows_(self, start_date, end_date, r_sku_codes):
+        """
+        Выполнение запроса продаж в 1С и чтение результата частями по self.chunk_size строк
+        :return generator of [()]:
+        """
+        with self.metrics.stage('sales.query_build'):
+            qry_sales = self._build_sales_query_(start_date, end_date, r_sku_codes)
+
+        logging.info('Getting connection to RARUS')
+        with self.connections.rarus() as rarus_connector, self.metrics.stage('sales.rarus_execute'):
+            logging.info(f'Quering data from RARUS. Profile: {self.profile}')
+            started = time.perf_counter()
+            query = rarus_connector.NewObject("Query", qry_sales)
+            sel = query.Execute().Choose()  # Get result of RARUS query
+            query_seconds = time.perf_counter() - started
+
+        if self.profile == 'lean':
+            get_row = lambda x: (x.ShopCode, x.Date_.date(), x.Code, x.Qty, x.Turnover, x.VAT, x.Cost, x.VATIn,
+                                 x.CustomerCode)
+        else:
+            get_row = lambda x: (x.Shop, x.Date_.date(), x.Code, x.Name, x.Qty, x.Turnover, x.Turnover_wo_vat,
+                                 x.COGS, x.Margin, x.Margin_percent, x.CustomerCode, x.Customer)
+
+        # Одна запись на запрос. transfer_bytes дописывает _sales_rows_to_df_ по частям этого запроса
+        extract = {'profile': self.profile, 'start_date': start_date, 'end_date': end_date,
+                   'query_seconds': round(query_seconds, 3), 'rows': 0, 'transfer_bytes': 0}
+        self.extract_stats.append(extract)
+        for chunk in measure_iter(iter_selection_chunks(sel, get_row, self.chunk_size), self.metrics,
+                                  'sales.row_iteration'):
+            extract['rows'] += len(chunk)
+            yield SelectionChunk(chunk, extract)
+
+        logging.info(f"RARUS query finished in {query_seconds:.3f}s. Rows: {extract['rows']}")
+
+    def _lean_rows_to_df_(self, data):
+        """
+        Профиль lean: расчет сумм без НДС, себестоимости и маржи как в запросе профиля full
+        и наименования из кэша справочников
+        :return df {DataFrame}, transfer_bytes: Колонки как у профиля full и объем данных, полученных из 1С
+        """
+        df = pd.DataFrame(data, columns=['shop_code', 'date_', 'code', 'quantity_sold', 'turnover', 'vat', 'cost',
+                                         'vat_in', 'client_code'])
+        transfer_bytes = int(df.memory_usage(deep=True).sum())
+
+        turnover_wo_vat = df['turnover'] - df['vat']
+        no_turnover = turnover_wo_vat == 0
+        margin = turnover_wo_vat - (df['cost'] - df['vat_in'])
+        return pd.DataFrame({
+            'branch': self.shops.map(df['shop_code']),
+            'date_': df['date_'],
+            'code': df['code'],
+            'name': self.skus.map(df['code']),
+            'quantity_sold': df['quantity_sold'],
+            'turnover': df['turnover'],
+            'turnover_wo_vat': turnover_wo_vat,
+            'cogs': df['cost'] - df['vat_in'],
+            'margin': margin.where(~no_turnover, 0).round(2),
+            'margin_percent': (margin / turnover_wo_vat.where(~no_turnover) * 100).fillna(0).round(2),
+            'client_code': df['client_code'],
+            'client': self.customers.map(df['client_code']),
+        }), transfer_bytes
+
+    def _sales_rows_to_df_(self, data):
+        """
+        Преобразование строк продаж из 1С в pd.Dataframe и установка покупателей.
+        Объем полученных из 1С данных прибавляется к transfer_bytes запроса части (SelectionChunk.extract)
+        :return df {DataFrame}:
+        """
         logging.info('Formating RARUS sales to pd.Dataframe')
-        df = pd.DataFrame(data,
-                          columns=['branch', 'date_', 'code', 'name', 'quantity_sold', 'turnover', 'turnover_wo_vat',
-                                   'cogs', 'margin', 'margin_percent', 'client_code', 'client'])
-        df.set_index('code', inplace=True)
-        df['log_date'] = datetime.datetime.now()
-        df_sales = self._set_customers_(df)
+        with self.metrics.stage('sales.dataframe_build') as stage:
+            if self.profile == 'lean':
+                df, transfer_bytes = self._lean_rows_to_df_(data)
+            else:
+                df = pd.DataFrame(data,
+                                  columns=['branch', 'date_', 'code', 'name', 'quantity_sold', 'turnover',
+                                           'turnover_wo_vat', 'cogs', 'margin', 'margin_percent', 'client_code',
+                                           'client'])
+                transfer_bytes = int(df.memory_usage(deep=True).sum())
+            extract = getattr(data, 'extract', None)
+            if extract is not None:
+                extract['transfer_bytes'] += transfer_bytes
+            df.set_index('code', inplace=True)
+            df['log_date'] = datetime.datetime.now()
+            stage.rows = len(df)
+            stage.bytes = transfer_bytes
+
+        df = self._set_customers_(df)
+        if self.compact:
+            with self.metrics.stage('sales.compact'):
+                df = compact_frame(df, ['branch', 'name', 'client'],
+                                   ['quantity_sold', 'turnover', 'turnover_wo_vat', 'cogs', 'margin',
+                                    'margin_percent'])
+        return df
+
+    def _cache_fingerprint_(self, r_sku_codes):
+        """
+        Отпечаток выгрузки продаж для кэша: профиль запроса и список товаров фильтра. Выгрузка дня содержит только
+        товары, которые были в DistributionGoods, поэтому после добавления товаров дни кэша становятся промахом
+        :param r_sku_codes: Кода товаров в формате РАРУС-а
+        """
+        codes = ','.join(sorted(r_sku_codes.split(',')))
+        return hashlib.sha1(f'{self.profile}|{codes}'.encode()).hexdigest()
+
+    def _get_sales_(self, start_date=None, end_date=None, r_sku_codes=None):
+        """
+
+        По периоду аналиаза получаем данные о продаж из 1С.
+        Сначала получим все 1С кода товаров дистрибуции из БД таблицы DistributionGoods и затем отфильтруем продажи
+        по полученным 1С кодам.
+
+        :param start_date: Дата начала. По умолчанию дата начала анализа
+        :param end_date: Дата конца. По умолчанию дата конца анализа
+        :param r_sku_codes: Кода товаров в формате РАРУС-а. Если не переданы, то получаются из БД
+        :return df {DataFrame}: данные по продажам за периоджд
+        """
+        start_date = start_date or self.start_date
+        end_date = end_date or self.end_date
+        if r_sku_codes is None:
+            r_sku_codes = self._get_rarus_sku_codes_()
+        if self.cache:
+            df = self.cache.read('sales', start_date, end_date, self._cache_fingerprint_(r_sku_codes))
+            if df is not None:
+                df['log_date'] = datetime.datetime.now()
+                return df
+
+        logging.info(f'Getting sales from RARUS for the period {start_date} - {end_date}')
+
+        data = SelectionChunk()
+        for chunk in self._iter_sales_rows_(start_date, end_date, r_sku_codes):
+            data.extend(chunk)
+            data.extract = chunk.extract
+        df = self._sales_rows_to_df_(data)
+        if self.cache:
+            self.cache.write('sales', df, start_date, end_date, fingerprint=self._cache_fingerprint_(r_sku_codes))
+
+        return df
+
+    def _save_sales_chunks_(self, start_date, end_date, r_sku_codes):
+        """
+        Потоковая выгрузка: каждая часть продаж из 1С обрабатывается и сразу записывается в БД
+        :return rows -> int: Количество записанных строк
+        """
+        fingerprint = self._cache_fingerprint_(r_sku_codes) if self.cache else None
+        if self.cache and not self.cache.missing_days('sales', start_date, end_date, fingerprint):
+            return self._save_sales_from_cache_(start_date, end_date, fingerprint, r_sku_codes)
+
+        logging.info(f'Streaming sales from RARUS for the period {start_date} - {end_date} by {self.chunk_size} rows')
+        rows = 0
+        cache_writer = self.cache.writer('sales', start_date, end_date, fingerprint=fingerprint) if self.cache \
+            else nullcontext()
+        with cache_writer, self._window_writer_(start_date, end_date) as save:
+            for data in self._iter_sales_rows_(start_date, end_date, r_sku_codes):
+                df = self._sales_rows_to_df_(data)
+                if self.cache:
+                    cache_writer.add(df)
+                save(df)
+                rows += len(df)
+
+        return rows
+
+    def _save_sales_from_cache_(self, start_date, end_date, fingerprint, r_sku_codes=None):
+        """
+        Запись продаж в БД из кэша по одному дню
+        :param fingerprint: Отпечаток выгрузки _cache_fingerprint_
+        :param r_sku_codes: Кода товаров в формате РАРУС-а. Если день исчез из кэша (вытеснение в другом потоке),
+            то он выгружается из 1С. Если не переданы, то исчезнувший день - ошибка
+        :return rows -> int: Количество записанных строк
+        """
+        rows = 0
+        with self._window_writer_(start_date, end_date) as save:
+            for day in self.cache.days(start_date, end_date):
+                df = self.cache.read_day('sales', day, fingerprint)
+                if df is None:
+                    assert r_sku_codes is not None, f'Day {day} is missing in cache'
+                    logging.info(f'Day {day} is missing in cache. Getting it from RARUS')
+                    for data in self._iter_sales_rows_(day, day, r_sku_codes):
+                        df = self._sales_rows_to_df_(data)
+                        save(df)
+                        rows += len(df)
+                elif not df.empty:
+                    df['log_date'] = datetime.datetime.now()
+                    save(df)
+                    rows += len(df)
+
+        return rows
+
+    def reload_from_cache(self, start_date, end_date):
+        """
+        Перезаливка продаж за период в БД только из кэша, без запроса в 1С.
+        Например, после изменения схемы таблицы или неудачной загрузки.
+        Все дни периода должны быть в кэше и выгружены с текущим списком товаров из БД.
+        :return rows -> int: Количество записанных строк
+        """
+        assert self.cache, 'Cache is not set'
+        fingerprint = self._cache_fingerprint_(self._get_rarus_sku_codes_())
+        missing_days = self.cache.missing_days('sales', start_date, end_date, fingerprint)
+        assert not missing_days, f'Days are missing in cache or were extracted with other goods: {missing_days}'
+
+        self.start_date = start_date
+        self.end_date = end_date
+        if not self.swap:
+            self._delete_from_db_table()
+        rows = self._save_sales_from_cache_(start_date, end_date, fingerprint)
+        logging.info(f'Reloaded {rows} rows from cache')
+        return rows
+
+    def reconcile(self, start_date=None, end_date=None, tolerance=None):
+        """
+        Сверка продаж в БД с 1С и перезагрузка только отличающихся дней.
+        Из 1С и БД получаются контрольные суммы (количество, оборот, себестоимость) по дню и подразделению.
+        Дни, в которых хотя бы одна сумма отличается, удаляются из БД, их кэш сбрасывается, и продажи за эти дни
+        заново выгружаются из 1С (по одному дню на окно, параллельно в self.workers потоках).
+
+        :param start_date: Дата начала сверки. По умолчанию дата начала анализа
+        :param end_date: Дата конца сверки. По умолчанию дата конца анализа
+        :param tolerance: Допустимое расхождение сумм. По умолчанию RECONCILE_TOLERANCE
+        :return days -> [date]: Перезагруженные дни
+        """
+        self.start_date = start_date or self.start_date
+        self.end_date = end_date or self.end_date
+        assert self.start_date and self.end_date, 'Reconcile period is not set'
+        tolerance = self.RECONCILE_TOLERANCE if tolerance is None else tolerance
+
+        r_sku_codes = self._get_rarus_sku_codes_()
+        diff = self._diff_control_totals_(self._get_rarus_control_totals_(self.start_date, self.end_date, r_sku_codes),
+                                          self._get_db_control_totals_(self.start_date, self.end_date), tolerance)
+        days = sorted(set(diff['date_']))
+        for row in diff.itertuples(index=False):
+            logging.info(f'Control totals differ: {row}')
+        logging.info(f'Reconcile {self.start_date} - {self.end_date}: {len(days)} days differ {days}')
+
+        rows = 0
+        if days:
+            rows = sum(self._run_windows_(self._resync_window_, windows=[(day, day) for day in days],
+                                          r_sku_codes=r_sku_codes))
+        logging.info(f'Reconcile finished. Resynced days: {len(days)}, rows: {rows}')
+
+        self.metrics.set_info('reconcile', {'period': [self.start_date, self.end_date], 'days': days, 'rows': rows})
+        self.metrics.set_info('connections', self.connections.stats())
+        self.metrics.set_info('windows', self.windows_stats)
+        self.metrics.write()
+        return days
+
+    def _resync_window_(self, start_date, end_date, r_sku_codes):
+        """
+        Замена продаж окна в БД: удаление, сброс кэша и повторная выгрузка из 1С
+        :return rows -> int: Количество записанных строк
+        """
+        if self.cache:
+            self.cache.invalidate('sales', start_date, end_date)
+        if not self.swap:
+            self._delete_from_db_table(start_date, end_date)
+        if self.chunk_size:
+            return self._save_sales_chunks_(start_date, end_date, r_sku_codes)
+
+        df = self._get_sales_(start_date, end_date, r_sku_codes)
+        self._save_window_(df, start_date, end_date)
+        return len(df)
+
+    def _run_window_(self, func, start_date, end_date, r_sku_codes):
+        """
+        Выполнение func для одного окна
+        :param func: _get_sales_ или _save_sales_chunks_
+        :return (result, stats): Результат func и статистика окна (время выполнения и количество строк)
+        """
+        started = time.perf_counter()
+        result = func(start_date, end_date, r_sku_codes)
+        rows = len(result) if isinstance(result, pd.DataFrame) else result
+        stats = {'start_date': start_date, 'end_date': end_date,
+                 'seconds': round(time.perf_counter() - started, 3), 'rows': rows}
+
+        logging.info(f"Window {start_date} - {end_date} finished in {stats['seconds']}s. Rows: {stats['rows']}")
+        return result, stats
+
+    def _get_windows_(self):
+        """
+        Окна периода анализа. Если окно не задано, то весь период - одно окно.
+        Дни повторной синхронизации (resync_days) не выделяются в свои окна, а входят в первое окно новых дней,
+        поэтому заменяются с ним одной транзакцией
+        """
+        if not self.window:
+            return [(self.start_date, self.end_date)]
+        if not self.resync_end_date:
+            return self._split_period_(self.start_date, self.end_date, self.window)
+
+        windows = self._split_period_(self.resync_end_date + datetime.timedelta(days=1), self.end_date, self.window)
+        if not windows:
+            # Новых дней нет, заново выгружаются только дни повторной синхронизации
+            return [(self.start_date, self.end_date)]
+        windows[0] = (self.start_date, windows[0][1])
+        return windows
+
+    def _run_windows_(self, func, windows=None, r_sku_codes=None):
+        """
+        Выполнение func по окнам периода анализа. Окна выполняются параллельно в self.workers потоках, у каждого
+        потока одно подключение к 1С на все его окна.
+        Если одно из окон завершилось с ошибкой, то остальные потоки не берут новые окна, а ошибка пробрасывается
+        дальше.
+        :param windows: Окна [(date, date)]. По умолчанию окна периода анализа
+        :param r_sku_codes: Кода товаров в формате РАРУС-а. Если не переданы, то получаются из БД
+        :return results -> list: Результаты func по окнам в порядке окон
+        """
+        windows = windows or self._get_windows_()
+        logging.info(f'Getting sales by {len(windows)} windows ({self.window}) with {self.workers} workers')
+        if r_sku_codes is None:
+            r_sku_codes = self._get_rarus_sku_codes_()
+
+        pending = queue.Queue()
+        for number, window in enumerate(windows):
+            pending.put((number, window))
+        results = [None] * len(windows)
+        failed = threading.Event()
+
+        def worker():
+            with self.connections.rarus_thread():
+                while not failed.is_set():
+                    try:
+                        number, (start_date, end_date) = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        results[number] = self._run_window_(func, start_date, end_date, r_sku_codes)
+                    except Exception:
+                        failed.set()
+                        raise
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(windows))) as executor:
+            futures = [executor.submit(worker) for _ in range(min(self.workers, len(windows)))]
+            for future in futures:
+                future.result()
 
-        return df_sales
+        self.windows_stats = [stats for _, stats in results]
+        return [result for result, _ in results]
+
+    def _run_pipeline_(self):
+        """
+        Конвейер по окнам периода анализа: чтение частей из 1С -> pd.Dataframe и покупатели -> запись в БД
+        :return stats -> [dict]: Время работы и ожидания по этапам
+        """
+        windows = self._get_windows_()
+        r_sku_codes = self._get_rarus_sku_codes_()
+
+        def extract():
+            for start_date, end_date in windows:
+                yield from self._iter_sales_rows_(start_date, end_date, r_sku_codes)
+
+        pipeline = Pipeline(extract, [('transform', self._sales_rows_to_df_),
+                                      ('load', partial(self.save_to_db, refresh_rollups=False))],
+                            maxsize=self.queue_size, thread_context=self.connections.rarus_thread)
+        self.pipeline_stats = pipeline.run()
+        self._refresh_rollups_(self.start_date, self.end_date)
+        return self.pipeline_stats
+
+    def _get_sales_windowed_(self):
+        """
+        Выгрузка продаж из 1С по окнам
+        :return df {DataFrame}: данные по продажам за весь период анализа
+        """
+        frames = self._run_windows_(self._get_sales_)
+        logging.info(f'Finished. Rows: {sum(len(df) for df in frames)}')
+        return pd.concat(frames)
+
+    def _stream_sales_to_db_(self):
+        """
+        Потоковая выгрузка продаж за период анализа (по окнам, если окно задано)
+        :return rows -> int: Количество записанных строк
+        """
+        if not self.checkpoint:
+            rows = sum(self._run_windows_(self._save_sales_chunks_))
+            logging.info(f'Finished. Saved rows: {rows}')
+            return rows
+
+        windows = self._get_windows_()
+        pending = self.checkpoint.pending(windows)
+        logging.info(f'Checkpoint {self.checkpoint.path}: {len(windows) - len(pending)} of {len(windows)} windows '
+                     f'are done')
+        if not pending:
+            return 0
+        rows = sum(self._run_windows_(self._save_sales_checkpointed_, windows=pending))
+        logging.info(f'Finished. Saved rows: {rows}')
+        return rows
+
+    def _save_sales_checkpointed_(self, start_date, end_date, r_sku_codes):
+        """
+        Потоковая выгрузка окна и отметка окна в checkpoint
+        :return rows -> int: Количество записанных строк
+        """
+        rows = self._save_sales_chunks_(start_date, end_date, r_sku_codes)
+        self.checkpoint.mark_done(start_date, end_date, rows)
+        return rows
 
     @staticmethod
     def _get_customer_(x):
@@ -379,6 +1338,8 @@ class DistributionSales:
         продала товар дистрибуции.
         Если покупатель не частное лицо и продавцом является ДМ АШАН, то это отдел Б2Б
 
+        Построчная версия правил CUSTOMER_RULES. В _set_customers_ используется векторная версия.
+
         :param x: pd.Series. Строка из pd.Dataframe
         :return:
         """
@@ -396,22 +1357,102 @@ class DistributionSales:
         :return:
         """
         logging.info('Setting customers..')
-        df['client'] = df.apply(lambda x: self._get_customer_(x), axis=1)
-        df.drop('client_code', axis=1, inplace=True)
+        with self.metrics.stage('sales.set_customers') as stage:
+            conditions = [(df[rule['column']] == rule['equals']).to_numpy() for rule in self.CUSTOMER_RULES]
+            choices = [df[rule['client_from']].to_numpy(dtype=object) if 'client_from' in rule else rule['client']
+                       for rule in self.CUSTOMER_RULES]
+            df['client'] = np.select(conditions, choices, default=df['client'].to_numpy(dtype=object))
+            df.drop('client_code', axis=1, inplace=True)
+            stage.rows = len(df)
 
         logging.info('Finished!')
         return df
 
-    def save_to_db(self, df):
+    def save_to_db(self, df, refresh_rollups=True):
+        """
+        :param df: Продажи
+        :param refresh_rollups: Пересчитать агрегаты по дням df. Выгрузка по окнам пересчитывает агрегаты один раз
+            на окно
+        """
         logging.info('Saving data to database..')
-        db_session = create_sql02_connection()
-        df.to_sql(self.DB_TABLE_NAME, db_session.cursor(), if_exists='append')
-        db_session.commit()
-        db_session.close()
-        logging.info('Finished!')
+        with self.connections.sql() as db_session:
+            if self.compact:
+                with self.metrics.stage('sales.encode_dimensions'):
+                    df = self.dimensions.encode(db_session, df)
+            with self.metrics.stage('sales.load') as stage:
+                stage.bytes = int(df.memory_usage(deep=True).sum())
+                rows = stage.rows = self.loader.load(db_session, self.DB_TABLE_NAME, df)
+        logging.info(f'Finished! Saved {rows} rows')
 
+        if refresh_rollups and rows:
+            dates = pd.to_datetime(df['date_'])
+            self._refresh_rollups_(dates.min().date(), dates.max().date())
+
+    def _refresh_rollups_(self, start_date, end_date):
+        """
+        Пересчет периодов агрегатов, которые пересекаются с периодом start_date - end_date
+        """
+        if not self.rollups:
+            return
+        with self.connections.sql() as db_session, self.metrics.stage('sales.rollups'):
+            self.rollups.refresh(db_session, start_date, end_date)
+
+    def rebuild_rollups(self):
+        """
+        Полный пересчет агрегатов по всей таблице продаж
+        :return buckets -> int: Количество пересчитанных периодов
+        """
+        assert self.rollups, 'Rollups are not enabled'
+        with self.connections.sql() as db_session, self.metrics.stage('sales.rollups_rebuild'):
+            return self.rollups.rebuild(db_session)
+
+    def check_rollups(self, start_date=None, end_date=None):
+        """
+        Сверка агрегатов с таблицей продаж (см. RollupStore.check)
+        :return mismatches -> [dict]:
+        """
+        assert self.rollups, 'Rollups are not enabled'
+        with self.connections.sql() as db_session:
+            mismatches = self.rollups.check(db_session, start_date, end_date)
+        for mismatch in mismatches:
+            logging.warning(f'Rollup mismatch: {mismatch}')
+        return mismatches
+
+    @contextmanager
+    def _window_writer_(self, start_date, end_date):
+        """
+        Запись продаж окна в БД частями.
+        Без swap каждая часть сразу дописывается через save_to_db. В режиме swap части пишутся в staging таблицу,
+        а при выходе без ошибки заменяют продажи окна одной транзакцией. Затем пересчитываются агрегаты окна
+        :return save(df): Функция записи одной части
+        """
+        if not self.swap:
+            yield partial(self.save_to_db, refresh_rollups=False)
+            self._refresh_rollups_(start_date, end_date)
+            return
+
+        logging.info(f'Swapping sales for the period {start_date} - {end_date}')
+        with self.connections.sql() as db_session, \
+                self.loader.window_swap(db_session, self.DB_TABLE_NAME, start_date, end_date) as window_swap:
+
+            def save(df):
+                if self.compact:
+                    with self.metrics.stage('sales.encode_dimensions'):
+                        df = self.dimensions.encode(db_session, df)
+                with self.metrics.stage('sales.load') as stage:
+                    stage.bytes = int(df.memory_usage(deep=True).sum())
+                    stage.rows = window_swap.add(df)
+
+            yield save
+            with self.metrics.stage('sales.swap') as stage:
+                rows = stage.rows = window_swap.commit()
+        logging.info(f'Finished! Swapped {rows} rows')
+        self._refresh_rollups_(start_date, end_date)
+
+    def _save_window_(self, df, start_date, end_date):
+        """
+        Запись всех продаж окна в БД (см. _window_writer_)
+        """
+        with self._window_writer_(start_date, end_date) as save:
+            save(df)
 
-if __name__ == '__main__':
-    DistributionGoods().__call__()
-    sales = DistributionSales(append=True)
-    sales()
@@ -0,0 +1,299 @@
+import logging
+from abc import ABC, abstractmethod
+
+import pandas as pd
+
+
+def dataframe_to_records(df):
+    """
+    Подготовка pd.Dataframe к записи через executemany.
+    Именованный индекс становится колонкой (как в df.to_sql), numpy типы и Timestamp переводятся в типы python,
+    NaN/NaT в None.
+
+    :param df: Данные для записи
+    :return (columns, records): Список колонок и список tuple-ов
+    """
+    if df.index.name is not None:
+        df = df.reset_index()
+
+    values = df.astype(object).where(df.notna(), None)
+    columns = []
+    for column, dtype in df.dtypes.items():
+        column_values = values[column].tolist()
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            column_values = [None if value is None else value.to_pydatetime() for value in column_values]
+        columns.append(column_values)
+
+    return list(df.columns), list(zip(*columns))
+
+
+class BulkLoader(ABC):
+    """
+    Базовый загрузчик pd.Dataframe в таблицу БД.
+    Запись идет параметризованным executemany пачками по batch_size строк. Коммит делается каждые commit_every пачек
+    и в конце загрузки.
+
+    Поддерживаемые диалекты:
+        mssql - SQL Server через pyodbc (для курсора включается fast_executemany)
+        sqlite - sqlite3, для локальных замеров. Имя таблицы вида DB.dbo.Table превращается в Table
+    """
+    DIALECTS = ('mssql', 'sqlite')
+
+    def __init__(self, dialect='mssql', batch_size=10000, commit_every=None):
+        """
+        :param dialect: 'mssql' или 'sqlite'
+        :param batch_size: Количество строк в одном executemany
+        :param commit_every: Коммит через каждые commit_every пачек. Если None, то один коммит в конце загрузки
+        """
+        assert dialect in self.DIALECTS, f'Wrong dialect. Use one of {self.DIALECTS}'
+        assert batch_size >= 1, 'Batch size must be >= 1'
+        self.dialect = dialect
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+
+    def table_name(self, name):
+        """
+        Имя таблицы в диалекте загрузчика
+        """
+        if self.dialect == 'sqlite':
+            return name.split('.')[-1]
+        return name
+
+    def _cursor_(self, db_session):
+        cursor = db_session.cursor()
+        if hasattr(cursor, 'fast_executemany'):  # pyodbc
+            cursor.fast_executemany = True
+        return cursor
+
+    def _executemany_(self, db_session, cursor, sql, records):
+        """
+        Выполнение параметризованного запроса пачками по batch_size строк
+        """
+        for batch_number, start in enumerate(range(0, len(records), self.batch_size), start=1):
+            cursor.executemany(sql, records[start:start + self.batch_size])
+            if self.commit_every and batch_number % self.commit_every == 0:
+                db_session.commit()
+
+    def _insert_(self, db_session, cursor, table, columns, records):
+        """
+        Вставка записей пачками по batch_size строк
+        """
+        sql = f"insert into {table} ({', '.join(columns)}) values ({', '.join('?' * len(columns))})"
+        self._executemany_(db_session, cursor, sql, records)
+
+    def insert_missing(self, db_session, table, df, key_column):
+        """
+        Запись строк, значения key_column которых еще нет в таблице: MERGE ... WITH (HOLDLOCK) в mssql,
+        INSERT OR IGNORE по уникальному индексу key_column в sqlite. Если то же значение одновременно пишет другой
+        процесс, то строка не дублируется и ошибки нет. Ключи identity выдает БД.
+        :param key_column: Натуральный ключ таблицы
+        :return rows -> int: Количество переданных строк
+        """
+        table = self.table_name(table)
+        columns, records = dataframe_to_records(df)
+        columns_str = ', '.join(columns)
+        placeholders = ', '.join('?' * len(columns))
+        if self.dialect == 'sqlite':
+            sql = f'insert or ignore into {table} ({columns_str}) values ({placeholders})'
+        else:
+            sql = f"""
+            merge {table} with (holdlock) as target
+            using (values ({placeholders})) as source ({columns_str})
+            on target.{key_column} = source.{key_column}
+            when not matched then
+                insert ({columns_str}) values ({', '.join(f'source.{column}' for column in columns)});
+            """
+        logging.info(f'Inserting {len(records)} missing rows to {table} by {self.batch_size} rows')
+
+        cursor = self._cursor_(db_session)
+        self._executemany_(db_session, cursor, sql, records)
+        db_session.commit()
+        cursor.close()
+
+        return len(records)
+
+    @abstractmethod
+    def load(self, db_session, table, df):
+        """
+        Запись данных в таблицу БД
+        :param db_session: Подключение к БД
+        :param table: Имя таблицы
+        :param df: Данные для записи
+        :return rows -> int: Количество записанных строк
+        """
+
+
+class ExecuteManyLoader(BulkLoader):
+    """
+    Запись напрямую в таблицу пачками executemany
+    """
+
+    def load(self, db_session, table, df):
+        table = self.table_name(table)
+        columns, records = dataframe_to_records(df)
+        logging.info(f'Loading {len(records)} rows to {table} by {self.batch_size} rows')
+
+        cursor = self._cursor_(db_session)
+        self._insert_(db_session, cursor, table, columns, records)
+        db_session.commit()
+        cursor.close()
+
+        return len(records)
+
+
+class StagingTableLoader(BulkLoader):
+    """
+    Запись во временную staging таблицу пачками executemany и перенос в основную таблицу одним INSERT ... SELECT.
+    Основная таблица не видит частично записанные данные и блокируется только на время одного INSERT ... SELECT.
+    """
+
+    def staging_table_name(self, table):
+        """
+        Имя временной staging таблицы для таблицы table
+        """
+        name = table.split('.')[-1]
+        if self.dialect == 'sqlite':
+            return f'temp.stage_{name}'
+        return f'#stage_{name}'
+
+    def _create_staging_table_(self, cursor, table, staging_table, columns):
+        """
+        Создание пустой staging таблицы со структурой колонок основной таблицы
+        """
+        columns_str = ', '.join(columns)
+        cursor.execute(f'drop table if exists {staging_table}')
+        if self.dialect == 'sqlite':
+            cursor.execute(f'create table {staging_table} as select {columns_str} from {table} where 0 = 1')
+        else:
+            cursor.execute(f'select top 0 {columns_str} into {staging_table} from {table}')
+
+    def _stage_(self, db_session, cursor, table, df):
+        """
+        Создание staging таблицы и запись в нее данных
+        :return (staging_table, columns, rows):
+        """
+        columns, records = dataframe_to_records(df)
+        staging_table = self.staging_table_name(table)
+        logging.info(f'Loading {len(records)} rows to {staging_table} by {self.batch_size} rows')
+
+        self._create_staging_table_(cursor, table, staging_table, columns)
+        self._insert_(db_session, cursor, staging_table, columns, records)
+        return staging_table, columns, len(records)
+
+    def load(self, db_session, table, df):
+        table = self.table_name(table)
+        cursor = self._cursor_(db_session)
+        staging_table, columns, rows = self._stage_(db_session, cursor, table, df)
+
+        logging.info(f'Moving {rows} rows from {staging_table} to {table}')
+        columns_str = ', '.join(columns)
+        cursor.execute(f'insert into {table} ({columns_str}) select {columns_str} from {staging_table}')
+        cursor.execute(f'drop table {staging_table}')
+        db_session.commit()
+        cursor.close()
+
+        return rows
+
+    def window_swap(self, db_session, table, start_date, end_date, date_column='date_'):
+        """
+        Замена строк периода таблицы через staging таблицу (см. WindowSwap)
+        """
+        return WindowSwap(self, db_session, table, start_date, end_date, date_column)
+
+
+class WindowSwap:
+    """
+    Замена строк периода в таблице одной транзакцией.
+    Части данных периода пишутся во временную staging таблицу (add), затем commit() удаляет строки периода из
+    основной таблицы и переносит строки из staging в одной транзакции. Повторная или пересекающаяся запись того же
+    периода не дублирует строки, а при ошибке до commit() основная таблица не меняется.
+
+    Использование:
+        with loader.window_swap(db_session, table, start_date, end_date) as swap:
+            for df in frames:
+                swap.add(df)
+            swap.commit()
+    """
+
+    def __init__(self, loader, db_session, table, start_date, end_date, date_column='date_'):
+        """
+        :param loader: StagingTableLoader
+        :param db_session: Подключение к БД. Staging таблица живет в этом подключении
+        :param table: Имя основной таблицы
+        :param start_date: Дата начала периода
+        :param end_date: Дата конца периода включительно
+        :param date_column: Колонка даты основной таблицы
+        """
+        self.loader = loader
+        self.db_session = db_session
+        self.table = loader.table_name(table)
+        self.staging_table = loader.staging_table_name(self.table)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.date_column = date_column
+        self.columns = None
+        self.rows = 0
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = self.loader._cursor_(self.db_session)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.db_session.rollback()
+        if self.columns is not None:
+            self.cursor.execute(f'drop table if exists {self.staging_table}')
+            self.db_session.commit()
+        self.cursor.close()
+
+    def add(self, df):
+        """
+        Запись части данных периода в staging таблицу
+        :return rows -> int: Количество записанных строк
+        """
+        columns, records = dataframe_to_records(df)
+        if self.columns is None:
+            self.loader._create_staging_table_(self.cursor, self.table, self.staging_table, columns)
+            self.columns = columns
+        assert columns == self.columns, f'Columns {columns} differ from staged columns {self.columns}'
+
+        logging.info(f'Loading {len(records)} rows to {self.staging_table} by {self.loader.batch_size} rows')
+        self.loader._insert_(self.db_session, self.cursor, self.staging_table, columns, records)
+        # Коммит только staging таблицы: подключение не держит блокировки до commit() окна
+        self.db_session.commit()
+        self.rows += len(records)
+        return len(records)
+
+    def commit(self):
+        """
+        Удаление строк периода из основной таблицы и перенос строк из staging одной транзакцией
+        :return rows -> int: Количество строк периода в основной таблице
+        """
+        logging.info(f'Replacing {self.table} rows for the period {self.start_date} - {self.end_date} '
+                     f'with {self.rows} rows from {self.staging_table}')
+        self.cursor.execute(f"delete from {self.table} "
+                            f"where {self.date_column} between '{self.start_date}' and '{self.end_date}'")
+        if self.columns is not None:
+            columns_str = ', '.join(self.columns)
+            self.cursor.execute(f'insert into {self.table} ({columns_str}) '
+                                f'select {columns_str} from {self.staging_table}')
+        self.db_session.commit()
+        return self.rows
+
+
+LOADERS = {
+    'executemany': ExecuteManyLoader,
+    'staging': StagingTableLoader,
+}
+
+
+def get_loader(name='executemany', **kwargs):
+    """
+    Загрузчик по имени из LOADERS
+    :param name: Имя загрузчика
+    :param kwargs: Параметры загрузчика (dialect, batch_size, commit_every)
+    :return loader -> BulkLoader:
+    """
+    assert name in LOADERS, f'Wrong loader. Use one of {tuple(LOADERS)}'
+    return LOADERS[name](**kwargs)
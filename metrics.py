@@ -0,0 +1,231 @@
+import cProfile
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil  # память процесса. На Windows обязателен: без него память в метриках не пишется (нет resource)
+except ImportError:
+    psutil = None
+
+# Каталог по умолчанию для JSON файлов метрик и профилей
+METRICS_DIR = './logs'
+
+
+def peak_rss_mb():
+    """
+    Пиковая память процесса в МБ за все время работы процесса. None, если ее нельзя получить
+    (на Windows без psutil)
+    """
+    if resource is not None:
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return round(getattr(memory, 'peak_wset', memory.rss) / 1024 / 1024, 1)
+    return None
+
+
+def current_rss_mb():
+    """
+    Текущая память процесса (RSS) в МБ: psutil или /proc/self/statm на Linux. None, если ее нельзя получить
+    """
+    if psutil is not None:
+        return round(psutil.Process().memory_info().rss / 1024 / 1024, 1)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return round(pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+
+
+class Stage:
+    """
+    Один вызов этапа. Код этапа может заполнить rows и bytes
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+
+
+class RunMetrics:
+    """
+    Метрики одного запуска по этапам: количество вызовов, время, строки, байты и память.
+
+    Память этапа - RSS процесса до и после каждого вызова (current_rss_mb): rss_mb - RSS после последнего вызова,
+    max_rss_growth_mb - наибольший рост RSS за один вызов. Это память всего процесса, поэтому при параллельных
+    этапах рост включает и память других потоков. Пиковая память процесса за весь запуск - peak_rss_mb в as_dict().
+
+    Использование:
+        with metrics.stage('sales.load') as stage:
+            stage.rows = loader.load(...)
+
+    В конце запуска write() сохраняет метрики в JSON ({output_dir}/metrics_{run}_{время}.json)
+    и, если задан prometheus_path, в текстовый файл для node_exporter textfile collector.
+    Если вызов этапа дольше порога из slow_stage_seconds, то пишется warning.
+    Если задан profile_dir, то этапы из profile_stages профилируются cProfile и сохраняются в .prof файлы.
+    """
+    # Горячие циклы, которые профилируются при profile_dir
+    PROFILE_STAGES = ('row_iteration', 'dataframe_build', 'set_customers', 'load')
+
+    def __init__(self, run, output_dir=METRICS_DIR, prometheus_path=None, slow_stage_seconds=None, profile_dir=None,
+                 profile_stages=PROFILE_STAGES):
+        """
+        :param run: Имя запуска, например 'goods' или 'sales'
+        :param output_dir: Каталог для JSON файла метрик. Если None, то JSON не пишется
+        :param prometheus_path: Путь к .prom файлу
+        :param slow_stage_seconds: Пороги медленных этапов {имя этапа: секунды}
+        :param profile_dir: Каталог для профилей cProfile. Если None, то профилирование выключено
+        :param profile_stages: Окончания имен этапов, которые профилируются
+        """
+        self.run = run
+        self.output_dir = output_dir
+        self.prometheus_path = prometheus_path
+        self.slow_stage_seconds = slow_stage_seconds or {}
+        self.profile_dir = profile_dir
+        self.profile_stages = profile_stages
+        self.started_at = datetime.datetime.now()
+        self.stages = {}
+        self.info = {}
+        self._profiles = {}
+        self._profile_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def _profile_(self, name):
+        """
+        Профилировщик для этапа или None. Одновременно профилируется только один вызов (cProfile работает
+        в одном потоке), вызовы этапов из других потоков в это время не профилируются.
+        """
+        if not self.profile_dir or not name.endswith(self.profile_stages):
+            return None
+        if not self._profile_lock.acquire(blocking=False):
+            return None
+        return self._profiles.setdefault(name, cProfile.Profile())
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Замер одного вызова этапа
+        """
+        stage = Stage(name)
+        profile = self._profile_(name)
+        if profile is not None:
+            profile.enable()
+        rss_before_mb = current_rss_mb()
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            seconds = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+                self._profile_lock.release()
+            self.add(name, seconds, stage.rows, stage.bytes, rss_before_mb)
+
+    def add(self, name, seconds, rows=0, bytes_=0, rss_before_mb=None):
+        """
+        Добавление замера этапа, который измерен снаружи
+        :param rss_before_mb: RSS процесса перед вызовом этапа. Если не задан, то рост памяти не считается
+        """
+        rss_mb = current_rss_mb()
+        with self._lock:
+            record = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0,
+                                                   'bytes': 0, 'rss_mb': None, 'max_rss_growth_mb': None})
+            record['calls'] += 1
+            record['seconds'] += seconds
+            record['max_seconds'] = max(record['max_seconds'], seconds)
+            record['rows'] += rows or 0
+            record['bytes'] += bytes_ or 0
+            record['rss_mb'] = rss_mb
+            if rss_mb is not None and rss_before_mb is not None:
+                growth = round(rss_mb - rss_before_mb, 1)
+                if record['max_rss_growth_mb'] is None or growth > record['max_rss_growth_mb']:
+                    record['max_rss_growth_mb'] = growth
+
+        threshold = self.slow_stage_seconds.get(name)
+        if threshold is not None and seconds > threshold:
+            logging.warning(f'Slow stage {name}: {seconds:.3f}s > {threshold}s')
+
+    def set_info(self, key, value):
+        """
+        Дополнительные данные запуска (параметры, статистика подключений и т.п.)
+        """
+        self.info[key] = value
+
+    def as_dict(self):
+        with self._lock:
+            stages = {name: {**record, 'seconds': round(record['seconds'], 3),
+                             'max_seconds': round(record['max_seconds'], 3)}
+                      for name, record in self.stages.items()}
+        return {'run': self.run, 'started_at': self.started_at.isoformat(),
+                'finished_at': datetime.datetime.now().isoformat(), 'peak_rss_mb': peak_rss_mb(),
+                'stages': stages, 'info': self.info}
+
+    def to_prometheus(self):
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        data = self.as_dict()
+        lines = []
+        for metric, field in (('seconds', 'seconds'), ('rows', 'rows'), ('bytes', 'bytes'), ('calls', 'calls')):
+            lines.append(f'# TYPE distribution_stage_{metric} gauge')
+            for name, record in data['stages'].items():
+                lines.append(f'distribution_stage_{metric}{{run="{self.run}",stage="{name}"}} {record[field]}')
+        if data['peak_rss_mb'] is not None:
+            lines.append('# TYPE distribution_peak_rss_mb gauge')
+            lines.append(f'distribution_peak_rss_mb{{run="{self.run}"}} {data["peak_rss_mb"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Сохранение метрик запуска
+        :return path: Путь к JSON файлу или None
+        """
+        data = self.as_dict()
+        logging.info(f'Run metrics: {json.dumps(data, default=str)}')
+
+        path = None
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir,
+                                f"metrics_{self.run}_{self.started_at.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+
+        if self.prometheus_path:
+            tmp_path = f'{self.prometheus_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, self.prometheus_path)
+
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(self.profile_dir, f'{self.run}_{name}.prof'))
+
+        return path
+
+
+def measure_iter(chunks, metrics, name):
+    """
+    Замер получения каждой части итератора как вызова этапа name (например, чтение выборки 1С частями)
+    """
+    chunks = iter(chunks)
+    while True:
+        with metrics.stage(name) as stage:
+            chunk = next(chunks, None)
+            stage.rows = len(chunk) if chunk is not None else 0
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+# Признак конца данных в очереди между этапами
+_END = object()
+
+
+class StageStats:
+    """
+    Статистика этапа конвейера:
+        busy_seconds - время работы самого этапа
+        wait_seconds - время ожидания: входных данных от предыдущего этапа или места в очереди следующего
+        items - количество обработанных элементов
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.items = 0
+
+    def as_dict(self):
+        return {'stage': self.name, 'busy_seconds': round(self.busy_seconds, 3),
+                'wait_seconds': round(self.wait_seconds, 3), 'items': self.items}
+
+
+class Pipeline:
+    """
+    Конвейер extract -> transform -> load. Каждый этап работает в своем потоке, этапы связаны очередями
+    ограниченного размера. Пока этап N обрабатывает часть данных, этап N-1 уже готовит следующую часть.
+    В памяти одновременно не больше maxsize частей на каждую очередь.
+
+    Если этап падает с ошибкой, то остальные этапы останавливаются, а ошибка пробрасывается из run().
+    """
+
+    def __init__(self, source, stages, maxsize=2, source_name='extract', thread_context=nullcontext):
+        """
+        :param source: Функция без параметров, которая возвращает итератор частей данных (этап extract)
+        :param stages: Список (имя этапа, функция). Функция получает часть данных и возвращает часть для следующего
+            этапа. Результат последнего этапа не используется
+        :param maxsize: Размер очереди между этапами
+        :param source_name: Имя этапа source в статистике
+        :param thread_context: Функция, которая возвращает контекст для каждого потока этапа
+            (например, ConnectionManager.rarus_thread для работы с 1С)
+        """
+        assert maxsize >= 1, 'Queue maxsize must be >= 1'
+        self.source = source
+        self.stages = stages
+        self.maxsize = maxsize
+        self.thread_context = thread_context
+        self.stats = [StageStats(source_name)] + [StageStats(name) for name, _ in stages]
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put_(self, out_queue, item, stats):
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.wait_seconds += time.perf_counter() - started
+
+    def _get_(self, in_queue, stats):
+        started = time.perf_counter()
+        item = _END
+        while not self._stop.is_set():
+            try:
+                item = in_queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        stats.wait_seconds += time.perf_counter() - started
+        return item
+
+    def _run_thread_(self, target, *args):
+        try:
+            with self.thread_context():
+                target(*args)
+        except Exception as err:
+            logging.exception(f'Pipeline stage failed: {err}')
+            self._errors.append(err)
+            self._stop.set()
+
+    def _run_source_(self, out_queue, stats):
+        iterator = iter(self.source())
+        while not self._stop.is_set():
+            started = time.perf_counter()
+            item = next(iterator, _END)
+            stats.busy_seconds += time.perf_counter() - started
+            if item is _END:
+                break
+            stats.items += 1
+            self._put_(out_queue, item, stats)
+        self._put_(out_queue, _END, stats)
+
+    def _run_stage_(self, func, in_queue, out_queue, stats):
+        while not self._stop.is_set():
+            item = self._get_(in_queue, stats)
+            if item is _END:
+                break
+            started = time.perf_counter()
+            result = func(item)
+            stats.busy_seconds += time.perf_counter() - started
+            stats.items += 1
+            if out_queue is not None:
+                self._put_(out_queue, result, stats)
+        if out_queue is not None:
+            self._put_(out_queue, _END, stats)
+
+    def run(self):
+        """
+        Запуск конвейера и ожидание его завершения
+        :return stats -> [dict]: Статистика по этапам
+        """
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        threads = [threading.Thread(target=self._run_thread_, args=(self._run_source_, queues[0], self.stats[0]),
+                                    name=self.stats[0].name)]
+        for i, (name, func) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._run_thread_,
+                                            args=(self._run_stage_, func, queues[i], out_queue, self.stats[i + 1]),
+                                            name=name))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = [stage.as_dict() for stage in self.stats]
+        for stage in stats:
+            logging.info(f'Pipeline stage {stage}')
+        if self._errors:
+            raise self._errors[0]
+
+        return stats
@@ -0,0 +1,236 @@
+import datetime
+import logging
+import threading
+from contextlib import contextmanager
+
+from dimensions import DimensionStore
+
+
+class Rollup:
+    """
+    Таблица агрегатов продаж: начало периода (неделя/месяц) × бренд × key_column (подразделение или клиент).
+    Неделя начинается с понедельника, месяц с первого числа.
+    """
+    PERIODS = ('week', 'month')
+
+    def __init__(self, table, period, key_column):
+        assert period in self.PERIODS, f'Wrong period. Use one of {self.PERIODS}'
+        self.table = table
+        self.period = period
+        self.key_column = key_column
+
+    def period_start(self, day):
+        if self.period == 'week':
+            return day - datetime.timedelta(days=day.weekday())
+        return day.replace(day=1)
+
+    def period_end(self, start):
+        if self.period == 'week':
+            return start + datetime.timedelta(days=6)
+        return (start + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+
+    def buckets(self, start_date, end_date):
+        """
+        Периоды агрегата, которые пересекаются с периодом start_date - end_date
+        :return buckets -> [(date, date)]: Список периодов (начало, конец) включительно
+        """
+        buckets = []
+        current = self.period_start(start_date)
+        while current <= end_date:
+            buckets.append((current, self.period_end(current)))
+            current = self.period_end(current) + datetime.timedelta(days=1)
+
+        return buckets
+
+
+class RollupStore:
+    """
+    Агрегаты продаж для отчетов по брендам (бренд из таблицы товаров DistributionGoods).
+    После записи продаж пересчитываются только периоды агрегатов, в которые попали записанные дни: строки периода
+    удаляются из таблицы агрегата и заново считаются из таблицы продаж. Так агрегаты остаются верными и после
+    удаления или замены дней (reconcile, swap).
+
+    Пересчет периода - delete + insert в одной транзакции. Потоки одного процесса синхронизируются блокировкой,
+    а процессы (например, выгрузки соседних периодов с общим месяцем) - блокировкой периода агрегата в БД
+    (sp_getapplock на SQL Server). Таблицы агрегатов имеют уникальный индекс по периоду и группе, поэтому
+    пересчет без блокировки падает с ошибкой, а не дублирует строки.
+    """
+    ROLLUPS = (
+        Rollup('Analitycs.dbo.DistributionSalesWeekBranch', 'week', 'branch'),
+        Rollup('Analitycs.dbo.DistributionSalesMonthBranch', 'month', 'branch'),
+        Rollup('Analitycs.dbo.DistributionSalesWeekClient', 'week', 'client'),
+        Rollup('Analitycs.dbo.DistributionSalesMonthClient', 'month', 'client'),
+    )
+    # Суммируемые колонки продаж. Процент маржи в отчетах считается как margin / turnover_wo_vat
+    MEASURES = ('quantity_sold', 'turnover', 'turnover_wo_vat', 'cogs', 'margin')
+
+    def __init__(self, sales_table, goods_table, compact=False, dialect='mssql', lock_timeout_seconds=600):
+        """
+        :param sales_table: Таблица продаж
+        :param goods_table: Таблица товаров с брендами
+        :param compact: Таблица продаж компактного режима (ключи измерений dimensions.DimensionStore)
+        :param dialect: Диалект БД loaders.BulkLoader.DIALECTS. Блокировка периода в БД есть только у mssql,
+            в sqlite запись и так идет одной транзакцией на всю базу
+        :param lock_timeout_seconds: Сколько ждать блокировку периода, которую держит другой процесс
+        """
+        self.sales_table = sales_table
+        self.goods_table = goods_table
+        self.compact = compact
+        self.dialect = dialect
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self._lock = threading.Lock()
+
+    def _source_(self):
+        """
+        Источник агрегатов: продажи с брендом, подразделением и клиентом
+        :return (from_clause, columns): Текст FROM и выражения колонок {'brand', 'branch', 'client'}
+        """
+        if self.compact:
+            shops, skus, clients = DimensionStore.DIMENSIONS
+            from_clause = f"""
+            {self.sales_table} sales
+                left join {skus.table} skus on skus.{skus.id_column} = sales.{skus.id_column}
+                left join {self.goods_table} goods on goods.code = skus.{skus.key_column}
+                left join {shops.table} shops on shops.{shops.id_column} = sales.{shops.id_column}
+                left join {clients.table} clients on clients.{clients.id_column} = sales.{clients.id_column}
+            """
+            columns = {'brand': 'goods.brand', 'branch': f'shops.{shops.key_column}',
+                       'client': f'clients.{clients.key_column}'}
+        else:
+            from_clause = f"""
+            {self.sales_table} sales
+                left join {self.goods_table} goods on goods.code = sales.code
+            """
+            columns = {'brand': 'goods.brand', 'branch': 'sales.branch', 'client': 'sales.client'}
+
+        return from_clause, columns
+
+    def _bucket_select_(self, rollup, start_date, end_date):
+        """
+        Запрос агрегата периода из таблицы продаж: бренд, key_column и суммы MEASURES
+        """
+        from_clause, columns = self._source_()
+        key = columns[rollup.key_column]
+        measures = ', '.join(f'sum(sales.{measure}) as {measure}' for measure in self.MEASURES)
+        return f"""
+        select {columns['brand']} as brand, {key} as {rollup.key_column}, {measures}
+        from {from_clause}
+        where sales.date_ between '{start_date}' and '{end_date}'
+        group by {columns['brand']}, {key}
+        """
+
+    def _refresh_bucket_(self, db_session, rollup, start_date, end_date):
+        columns = ', '.join((rollup.key_column, *self.MEASURES))
+        db_session.execute(f"delete from {rollup.table} where period_start = '{start_date}'")
+        db_session.execute(f"""
+        insert into {rollup.table} (period_start, brand, {columns})
+        select '{start_date}', brand, {columns}
+        from ({self._bucket_select_(rollup, start_date, end_date)}) grouped
+        """)
+
+    @contextmanager
+    def _bucket_lock_(self, db_session, rollup, start_date):
+        """
+        Блокировка периода агрегата в БД на время его пересчета и коммита. Блокировка сессии, а не транзакции,
+        поэтому снимается явно после коммита (или закрытием сессии при ошибке)
+        """
+        if self.dialect != 'mssql':
+            yield
+            return
+
+        resource = f'{rollup.table}:{start_date}'
+        db_session.execute(f"""
+        declare @result int;
+        exec @result = sp_getapplock @Resource = '{resource}', @LockMode = 'Exclusive', @LockOwner = 'Session',
+            @LockTimeout = {self.lock_timeout_seconds * 1000};
+        if @result < 0 throw 50000, 'Rollup bucket {resource} is locked by another process', 1;
+        """)
+        try:
+            yield
+        finally:
+            db_session.execute(f"exec sp_releaseapplock @Resource = '{resource}', @LockOwner = 'Session'")
+
+    def refresh(self, db_session, start_date, end_date):
+        """
+        Пересчет периодов всех агрегатов, которые пересекаются с периодом start_date - end_date.
+        Каждый период пересчитывается и коммитится под своей блокировкой
+        :return buckets -> int: Количество пересчитанных периодов
+        """
+        buckets = 0
+        with self._lock:
+            for rollup in self.ROLLUPS:
+                for bucket_start, bucket_end in rollup.buckets(start_date, end_date):
+                    with self._bucket_lock_(db_session, rollup, bucket_start):
+                        self._refresh_bucket_(db_session, rollup, bucket_start, bucket_end)
+                        db_session.commit()
+                    buckets += 1
+
+        logging.info(f'Refreshed {buckets} rollup buckets for the period {start_date} - {end_date}')
+        return buckets
+
+    def _get_sales_period_(self, db_session):
+        """
+        :return (min_date, max_date): Период продаж в таблице продаж
+        """
+        return tuple(db_session.execute(f"select min(date_), max(date_) from {self.sales_table}").fetchone())
+
+    def rebuild(self, db_session):
+        """
+        Полный пересчет агрегатов по всей таблице продаж
+        :return buckets -> int: Количество пересчитанных периодов
+        """
+        logging.info('Rebuilding rollups')
+        with self._lock:
+            for rollup in self.ROLLUPS:
+                db_session.execute(f'delete from {rollup.table}')
+            db_session.commit()
+
+        start_date, end_date = self._get_sales_period_(db_session)
+        if start_date is None:
+            return 0
+        return self.refresh(db_session, start_date, end_date)
+
+    @staticmethod
+    def _fetch_groups_(db_session, qry):
+        """
+        :return groups -> dict: {(бренд, ключ): [суммы]}
+        """
+        return {(row[0], row[1]): [float(value or 0) for value in row[2:]]
+                for row in db_session.execute(qry).fetchall()}
+
+    def check(self, db_session, start_date=None, end_date=None, tolerance=0.01):
+        """
+        Сверка агрегатов с таблицей продаж: для каждого периода агрегата суммы из таблицы продаж (тот же запрос,
+        что и при пересчете) сравниваются с таблицей агрегата по каждой группе бренд × key_column.
+        Находит и неверные суммы, и строки, которые попали не в ту группу (например, бренд товара изменился
+        после пересчета)
+        :param start_date: Дата начала сверки. По умолчанию минимальная дата продаж
+        :param end_date: Дата конца сверки. По умолчанию максимальная дата продаж
+        :param tolerance: Допустимое расхождение сумм
+        :return mismatches -> [dict]: Группы периодов агрегатов, суммы которых отличаются от продаж. Группы, которой
+            нет в одной из сторон, считаются с нулевыми суммами
+        """
+        if not (start_date and end_date):
+            start_date, end_date = self._get_sales_period_(db_session)
+            if start_date is None:
+                return []
+
+        zeros = [0.0] * len(self.MEASURES)
+        mismatches = []
+        for rollup in self.ROLLUPS:
+            for bucket_start, bucket_end in rollup.buckets(start_date, end_date):
+                sales = self._fetch_groups_(db_session, self._bucket_select_(rollup, bucket_start, bucket_end))
+                rollup_groups = self._fetch_groups_(
+                    db_session, f"select brand, {rollup.key_column}, {', '.join(self.MEASURES)} from {rollup.table} "
+                                f"where period_start = '{bucket_start}'")
+                for group in sales.keys() | rollup_groups.keys():
+                    sales_sums = sales.get(group, zeros)
+                    rollup_sums = rollup_groups.get(group, zeros)
+                    if any(abs(a - b) > tolerance for a, b in zip(sales_sums, rollup_sums)):
+                        mismatches.append({'table': rollup.table, 'period_start': bucket_start, 'brand': group[0],
+                                           rollup.key_column: group[1],
+                                           'sales': dict(zip(self.MEASURES, sales_sums)),
+                                           'rollup': dict(zip(self.MEASURES, rollup_sums))})
+
+        logging.info(f'Rollups check {start_date} - {end_date}: {len(mismatches)} mismatches')
+        return mismatches
@@ -0,0 +1,49 @@
+-- Таблицы компактного режима DistributionSales(compact=True) (см. dimensions.DimensionStore.DIMENSIONS).
+-- Ключи измерений выдает БД (identity). Натуральный ключ уникален: новые значения пишутся MERGE по нему
+-- (loaders.BulkLoader.insert_missing), поэтому одновременная выгрузка из нескольких процессов не дублирует значения.
+-- Повторный запуск скрипта не пересоздает существующие таблицы.
+use Analitycs;
+go
+
+if object_id('dbo.DistributionDimShop', 'U') is null
+create table dbo.DistributionDimShop (
+    shop_id int identity(1, 1) not null constraint PK_DistributionDimShop primary key,
+    branch nvarchar(150) null constraint UQ_DistributionDimShop_branch unique
+);
+go
+
+if object_id('dbo.DistributionDimSku', 'U') is null
+create table dbo.DistributionDimSku (
+    sku_id int identity(1, 1) not null constraint PK_DistributionDimSku primary key,
+    code nvarchar(25) null constraint UQ_DistributionDimSku_code unique,
+    name nvarchar(250) null
+);
+go
+
+if object_id('dbo.DistributionDimClient', 'U') is null
+create table dbo.DistributionDimClient (
+    client_id int identity(1, 1) not null constraint PK_DistributionDimClient primary key,
+    client nvarchar(250) null constraint UQ_DistributionDimClient_client unique
+);
+go
+
+if object_id('dbo.DistributionSalesCompact', 'U') is null
+begin
+    create table dbo.DistributionSalesCompact (
+        id bigint identity(1, 1) not null constraint PK_DistributionSalesCompact primary key nonclustered,
+        shop_id int null,
+        date_ date not null,
+        sku_id int null,
+        client_id int null,
+        quantity_sold decimal(18, 3) null,
+        turnover decimal(18, 2) null,
+        turnover_wo_vat decimal(18, 2) null,
+        cogs decimal(18, 2) null,
+        margin decimal(18, 2) null,
+        margin_percent decimal(10, 2) null,
+        log_date datetime2(0) null
+    );
+    -- Удаление и замена окон (swap), максимальная дата и сверка идут по диапазону date_
+    create clustered index IX_DistributionSalesCompact_date on dbo.DistributionSalesCompact (date_);
+end
+go
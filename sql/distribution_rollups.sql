@@ -0,0 +1,71 @@
+-- Таблицы агрегатов продаж rollups.RollupStore.ROLLUPS: начало недели/месяца × бренд × подразделение/клиент.
+-- Бренд и ключ могут быть null (товар без бренда в DistributionGoods), поэтому вместо первичного ключа
+-- уникальный кластерный индекс по периоду и группе: пересчет и сверка идут по period_start, а одновременный
+-- пересчет одного периода двумя процессами падает с ошибкой, а не дублирует строки.
+-- Повторный запуск скрипта не пересоздает существующие таблицы.
+use Analitycs;
+go
+
+if object_id('dbo.DistributionSalesWeekBranch', 'U') is null
+begin
+    create table dbo.DistributionSalesWeekBranch (
+        period_start date not null,
+        brand nvarchar(100) null,
+        branch nvarchar(150) null,
+        quantity_sold decimal(18, 3) null,
+        turnover decimal(18, 2) null,
+        turnover_wo_vat decimal(18, 2) null,
+        cogs decimal(18, 2) null,
+        margin decimal(18, 2) null
+    );
+    create unique clustered index IX_DistributionSalesWeekBranch_period on dbo.DistributionSalesWeekBranch (period_start, brand, branch);
+end
+go
+
+if object_id('dbo.DistributionSalesMonthBranch', 'U') is null
+begin
+    create table dbo.DistributionSalesMonthBranch (
+        period_start date not null,
+        brand nvarchar(100) null,
+        branch nvarchar(150) null,
+        quantity_sold decimal(18, 3) null,
+        turnover decimal(18, 2) null,
+        turnover_wo_vat decimal(18, 2) null,
+        cogs decimal(18, 2) null,
+        margin decimal(18, 2) null
+    );
+    create unique clustered index IX_DistributionSalesMonthBranch_period on dbo.DistributionSalesMonthBranch (period_start, brand, branch);
+end
+go
+
+if object_id('dbo.DistributionSalesWeekClient', 'U') is null
+begin
+    create table dbo.DistributionSalesWeekClient (
+        period_start date not null,
+        brand nvarchar(100) null,
+        client nvarchar(250) null,
+        quantity_sold decimal(18, 3) null,
+        turnover decimal(18, 2) null,
+        turnover_wo_vat decimal(18, 2) null,
+        cogs decimal(18, 2) null,
+        margin decimal(18, 2) null
+    );
+    create unique clustered index IX_DistributionSalesWeekClient_period on dbo.DistributionSalesWeekClient (period_start, brand, client);
+end
+go
+
+if object_id('dbo.DistributionSalesMonthClient', 'U') is null
+begin
+    create table dbo.DistributionSalesMonthClient (
+        period_start date not null,
+        brand nvarchar(100) null,
+        client nvarchar(250) null,
+        quantity_sold decimal(18, 3) null,
+        turnover decimal(18, 2) null,
+        turnover_wo_vat decimal(18, 2) null,
+        cogs decimal(18, 2) null,
+        margin decimal(18, 2) null
+    );
+    create unique clustered index IX_DistributionSalesMonthClient_period on dbo.DistributionSalesMonthClient (period_start, brand, client);
+end
+go
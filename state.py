@@ -0,0 +1,137 @@
+import datetime
+import json
+import logging
+import os
+import threading
+
+# Каталог по умолчанию для файлов состояния (водяные знаки, индексы кодов)
+STATE_DIR = './state'
+
+
+class JsonState:
+    """
+    Состояние в JSON файле. Запись идет через временный файл и os.replace, поэтому при падении процесса
+    файл остается в последнем целом состоянии.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def dump(self, data: dict):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+
+class WatermarkStore(JsonState):
+    """
+    Водяные знаки по ключам: {ключ: дата и время}. Например, последний период согласования цен по поставщику.
+    """
+
+    def __init__(self, path=os.path.join(STATE_DIR, 'goods_watermarks.json')):
+        super().__init__(path)
+        self.watermarks = {key: datetime.datetime.fromisoformat(value) for key, value in self.load().items()}
+
+    def get(self, key):
+        return self.watermarks.get(key)
+
+    def advance(self, key, value):
+        """
+        Сдвинуть водяной знак вперед. Более ранние значения игнорируются.
+        """
+        if value is not None and (key not in self.watermarks or value > self.watermarks[key]):
+            self.watermarks[key] = value
+
+    def save(self):
+        logging.info(f'Saving watermarks to {self.path}')
+        self.dump({key: value.isoformat() for key, value in self.watermarks.items()})
+
+
+class CodeIndex:
+    """
+    Индекс уже известных кодов (например, 1С кодов товаров в БД) в памяти.
+    Если задан path, то индекс хранится на диске (один код в строке) и при следующем запуске читается из файла,
+    а не из БД.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.codes = None
+
+    def load(self, get_codes):
+        """
+        :param get_codes: Функция, которая возвращает список кодов. Вызывается, если индекса на диске нет
+        :return self:
+        """
+        if self.codes is not None:
+            return self
+
+        if self.path and os.path.exists(self.path):
+            logging.info(f'Loading code index from {self.path}')
+            with open(self.path, encoding='utf-8') as f:
+                self.codes = {line.rstrip('\n') for line in f if line.strip()}
+        else:
+            self.codes = set(get_codes())
+
+        logging.info(f'Code index contains {len(self.codes)} codes')
+        return self
+
+    def add(self, codes):
+        self.codes.update(codes)
+
+    def save(self):
+        if not self.path:
+            return
+        logging.info(f'Saving code index to {self.path}')
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(f'{code}\n' for code in sorted(self.codes))
+        os.replace(tmp_path, self.path)
+
+
+class WindowCheckpoint(JsonState):
+    """
+    Выполненные окна выгрузки: {"начало_конец": {"rows": строк, "finished_at": время}}.
+    Окно сохраняется в файл сразу после записи в БД, поэтому повторный запуск после сбоя пропускает выполненные окна.
+    """
+
+    def __init__(self, path=os.path.join(STATE_DIR, 'sales_checkpoint.json')):
+        super().__init__(path)
+        self.windows = self.load()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(start_date, end_date):
+        return f'{start_date}_{end_date}'
+
+    def is_done(self, start_date, end_date):
+        return self.key(start_date, end_date) in self.windows
+
+    def pending(self, windows):
+        """
+        :param windows: Окна [(date, date)]
+        :return windows -> [(date, date)]: Невыполненные окна
+        """
+        return [window for window in windows if not self.is_done(*window)]
+
+    def mark_done(self, start_date, end_date, rows):
+        with self._lock:
+            self.windows[self.key(start_date, end_date)] = {'rows': rows,
+                                                            'finished_at': datetime.datetime.now().isoformat()}
+            self.dump(self.windows)
+
+    def reset(self):
+        logging.info(f'Resetting checkpoint {self.path}')
+        with self._lock:
+            self.windows = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)